@@ -1,22 +1,32 @@
 import numpy as np
 import pandas as pd
 import os
-from sklearn.model_selection import train_test_split
-from env import host, user, password
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from datetime import datetime, timezone
 
-# Establish a connection
-def get_connection(db, user=user, host=host, password=password):
-    '''
-    This function uses my info from my env file to
-    create a connection url to access the CodeUp db.
-    '''
-    return f'mysql+pymysql://{user}:{password}@{host}/{db}'
+from instrument import instrumented
 
-def new_zillow_data():
+def get_zillow_query(start_date='2017-05-01', end_date='2017-08-31', fips=None, since=None):
     '''
-    This function reads the Zillow data from the CodeUp db into a df.
+    This function returns the sql query for the zillow data with transactions
+    between start_date and end_date (inclusive). Passing a fips code limits the
+    query to that county.
+
+    Passing since (a date) only returns transactions on or after that date and adds
+    pred.transactiondate to the selected columns, for incremental reads.
     '''
-    sql_query = '''SELECT prop.parcelid, 
+    start_date = pd.Timestamp(start_date).strftime('%Y-%m-%d')
+    end_date = pd.Timestamp(end_date).strftime('%Y-%m-%d')
+    fips_filter = '' if fips is None else f'''
+                    AND (prop.fips = {int(fips)})'''
+    since_filter = '' if since is None else f'''
+                    AND (pred.transactiondate >= '{pd.Timestamp(since).strftime('%Y-%m-%d')}')'''
+    transactiondate = '' if since is None else ''',
+                    pred.transactiondate'''
+    return f'''SELECT prop.parcelid, 
                     prop.bathroomcnt, 
                     prop.bedroomcnt, 
                     prop.calculatedbathnbr, 
@@ -29,33 +39,439 @@ def new_zillow_data():
                     prop.landtaxvaluedollarcnt, 
                     prop.taxamount, 
                     prop.propertylandusetypeid,
-                    proptype.propertylandusedesc
+                    proptype.propertylandusedesc{transactiondate}
             FROM properties_2017 as prop
             JOIN predictions_2017 as pred USING(parcelid)
             JOIN propertylandusetype as proptype USING(propertylandusetypeid)
-            WHERE (pred.transactiondate between '2017-05-01'
-							AND '2017-08-31')
+            WHERE (pred.transactiondate between '{start_date}'
+							AND '{end_date}')
 					AND (prop.propertylandusetypeid IN (260, 261, 262, 263, 264,
-                                                         268, 269, 273, 274, 275, 276, 279));
+                                                         268, 269, 273, 274, 275, 276, 279)){fips_filter}{since_filter};
                 '''
-    df = pd.read_sql(sql_query, get_connection('zillow'))
 
-    return df
+ZILLOW_QUERY = get_zillow_query()
 
+# The dtypes every zillow dataframe is cast to after a fetch. Numeric columns stay
+# float64 because the db columns are nullable.
+ZILLOW_SCHEMA = {
+    'parcelid': 'int64',
+    'bathroomcnt': 'float64',
+    'bedroomcnt': 'float64',
+    'calculatedbathnbr': 'float64',
+    'calculatedfinishedsquarefeet': 'float64',
+    'fips': 'float64',
+    'latitude': 'float64',
+    'longitude': 'float64',
+    'structuretaxvaluedollarcnt': 'float64',
+    'taxvaluedollarcnt': 'float64',
+    'landtaxvaluedollarcnt': 'float64',
+    'taxamount': 'float64',
+    'propertylandusetypeid': 'float64',
+    'propertylandusedesc': 'object',
+    # Columns derived in the db by build_zillow_query
+    'county': 'object',
+    'tax_rate': 'float64',
+    'bath_per_sqft': 'float64',
+}
 
-# Acquire Data
-def get_zillow_data(cached=False):
+# The sql expression for every feature build_zillow_query can select. The fills from
+# prepare.clean_zillow, prepare.get_county and the ratio features are computed in the db.
+ZILLOW_EXPRESSIONS = {
+    'parcelid': 'prop.parcelid',
+    'bathroomcnt': 'prop.bathroomcnt',
+    'bedroomcnt': 'prop.bedroomcnt',
+    'calculatedbathnbr': 'COALESCE(prop.calculatedbathnbr, prop.bathroomcnt)',
+    'calculatedfinishedsquarefeet': 'prop.calculatedfinishedsquarefeet',
+    'fips': 'prop.fips',
+    'latitude': 'prop.latitude',
+    'longitude': 'prop.longitude',
+    'structuretaxvaluedollarcnt': 'COALESCE(prop.structuretaxvaluedollarcnt, '
+                                  'prop.taxvaluedollarcnt - prop.landtaxvaluedollarcnt)',
+    'taxvaluedollarcnt': 'prop.taxvaluedollarcnt',
+    'landtaxvaluedollarcnt': 'prop.landtaxvaluedollarcnt',
+    'taxamount': 'prop.taxamount',
+    'propertylandusetypeid': 'prop.propertylandusetypeid',
+    'propertylandusedesc': 'proptype.propertylandusedesc',
+    'county': "CASE prop.fips WHEN 6037 THEN 'Los Angeles' "
+              "WHEN 6059 THEN 'Orange' WHEN 6111 THEN 'Ventura' END",
+    'tax_rate': 'prop.taxamount / prop.taxvaluedollarcnt',
+    'bath_per_sqft': 'prop.bathroomcnt / prop.calculatedfinishedsquarefeet',
+}
+
+# The columns prepare.prepare_zillow keeps (parcelid becomes the index)
+PREPARED_FEATURES = ['bathroomcnt', 'bedroomcnt', 'calculatedfinishedsquarefeet', 'taxvaluedollarcnt']
+
+# Establish a connection
+def get_connection(db, user=None, host=None, password=None):
+    '''
+    This function uses my info from my env file to
+    create a connection url to access the CodeUp db.
+    The env file is only read here, when a credential is not passed in.
+    '''
+    if None in (user, host, password):
+        import env
+        user = env.user if user is None else user
+        host = env.host if host is None else host
+        password = env.password if password is None else password
+    return f'mysql+pymysql://{user}:{password}@{host}/{db}'
+
+@lru_cache(maxsize=None)
+def get_engine(db, pool_size=5):
+    '''
+    This function returns a pooled sqlalchemy engine for the CodeUp db.
+    The engine is created once per db and reused, so repeated reads borrow
+    connections from the pool instead of opening new ones.
+    '''
+    import sqlalchemy
+
+    return sqlalchemy.create_engine(get_connection(db), pool_size=pool_size,
+                                    max_overflow=0, pool_pre_ping=True)
+
+@instrumented()
+def new_zillow_data(chunksize=None, start_date='2017-05-01', end_date='2017-08-31', con=None):
+    '''
+    This function reads the Zillow data from the CodeUp db into a df.
+
+    If chunksize is given it returns a generator of typed dataframes with at most
+    chunksize rows each instead (see stream_zillow_data). con can be any sqlalchemy
+    url or engine and defaults to the CodeUp zillow db.
+    '''
+    if chunksize is not None:
+        return stream_zillow_data(chunksize, start_date=start_date, end_date=end_date, con=con)
+
+    if con is None:
+        con = get_engine('zillow')
+    df = pd.read_sql(get_zillow_query(start_date, end_date), con)
+
+    return set_zillow_dtypes(df)
+
+@instrumented()
+def stream_zillow_data(chunksize=50000, start_date='2017-05-01', end_date='2017-08-31', con=None):
     '''
-    This function reads in zillow data from Codeup database and returns it
-    as a .csv file containing a single dataframe. 
+    This function yields the Zillow data from the CodeUp db as dataframes of at
+    most chunksize rows, cast to ZILLOW_SCHEMA.
+
+    The query runs on a server-side cursor (stream_results), so rows are pulled
+    from the db as each chunk is consumed and only one chunk is held in memory
+    at a time.
     '''
+    import sqlalchemy
+
+    if con is None:
+        con = get_engine('zillow')
+    engine = sqlalchemy.create_engine(con) if isinstance(con, str) else con
     
-    filename = "zillow.csv"
-    if cached == False or os.path.isfile(filename) == False:
+    sql_query = sqlalchemy.text(get_zillow_query(start_date, end_date))
+    with engine.connect().execution_options(stream_results=True) as conn:
+        for chunk in pd.read_sql(sql_query, conn, chunksize=chunksize):
+            yield set_zillow_dtypes(chunk)
+
+def set_zillow_dtypes(df):
+    '''
+    This function takes in a zillow dataframe and casts its columns to the
+    dtypes in ZILLOW_SCHEMA so that every fetch and every cache read hands
+    back the same schema.
+    '''
+    schema = {col: dtype for col, dtype in ZILLOW_SCHEMA.items() if col in df.columns}
+    return df.astype(schema)
+
+
+def get_date_partitions(start_date, end_date, freq='MS'):
+    '''
+    This function splits the date range between start_date and end_date (inclusive)
+    into consecutive, non-overlapping (start, end) pairs, one per period of freq.
+    '''
+    start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    starts = pd.date_range(start_date, end_date, freq=freq)
+    if len(starts) == 0 or starts[0] != start_date:
+        starts = starts.insert(0, start_date)
+    ends = list(starts[1:] - pd.Timedelta(days=1)) + [end_date]
+    return list(zip(starts, ends))
+
+def parallel_zillow_data(start_date='2017-01-01', end_date='2017-12-31', fips=(6037, 6059, 6111),
+                         freq='MS', max_workers=4, con=None):
+    '''
+    This function reads the Zillow data from the CodeUp db by splitting the query
+    into one partition per fips code and per period of freq, and running the
+    partitions at the same time on at most max_workers threads over a pooled engine.
+
+    The partitions are merged and sorted by parcelid, so the result does not
+    depend on which partition finishes first.
+    '''
+    import sqlalchemy
+
+    if con is None:
+        con = get_engine('zillow', pool_size=max_workers)
+    engine = sqlalchemy.create_engine(con) if isinstance(con, str) else con
+
+    partitions = [(county, start, end) for county in fips
+                  for start, end in get_date_partitions(start_date, end_date, freq)]
+
+    def read_partition(partition):
+        county, start, end = partition
+        return pd.read_sql(get_zillow_query(start, end, fips=county), engine)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        frames = list(executor.map(read_partition, partitions))
+
+    df = pd.concat(frames, ignore_index=True)
+    df = df.sort_values('parcelid', kind='mergesort', ignore_index=True)
+
+    return set_zillow_dtypes(df)
+
+
+def _bound_filters(column, lower=None, upper=None):
+    '''
+    Returns the sql filters that keep column strictly between lower and upper. A
+    bound that is None or infinite is left out; a NaN bound raises a ValueError.
+    '''
+    filters = []
+    for bound, operator in ((lower, '>'), (upper, '<')):
+        if bound is None:
+            continue
+        bound = float(bound)
+        if np.isnan(bound):
+            raise ValueError(f'{column} cutoff is NaN')
+        if np.isfinite(bound):
+            filters.append(f'({column} {operator} {bound!r})')
+    return filters
+
+def build_zillow_query(features=PREPARED_FEATURES, start_date='2017-05-01', end_date='2017-08-31',
+                       fips=None, tax_value_cutoff=None, square_feet_cutoffs=None):
+    '''
+    This function builds a sql query that returns parcelid plus the requested features
+    already cleaned the way prepare.clean_zillow cleans them:
+
+        - calculatedbathnbr and structuretaxvaluedollarcnt are filled in the db
+        - county, tax_rate and bath_per_sqft are computed in the db
+        - rows with a missing value in any column clean_zillow keeps are dropped
+          in the db, whether or not that column is selected
+
+    Only the requested columns are sent over the wire. tax_value_cutoff drops rows with
+    taxvaluedollarcnt at or above it (or, as a (lower, upper) pair, keeps rows
+    strictly between the bounds) and square_feet_cutoffs=(lower, upper) keeps rows
+    strictly between the bounds, so IQR cutoffs computed earlier can be applied in
+    the db. Infinite bounds are left out and NaN bounds raise a ValueError.
+
+    latitude and longitude come back unformatted; run them through
+    prepare.get_latitude and prepare.get_longitude.
+    '''
+    unknown = [feature for feature in features if feature not in ZILLOW_EXPRESSIONS]
+    if unknown:
+        raise ValueError(f'Unknown zillow features: {unknown}')
+
+    columns = ['parcelid'] + [feature for feature in features if feature != 'parcelid']
+    select = ',\n                    '.join(f'{ZILLOW_EXPRESSIONS[col]} AS {col}' for col in columns)
+
+    start_date = pd.Timestamp(start_date).strftime('%Y-%m-%d')
+    end_date = pd.Timestamp(end_date).strftime('%Y-%m-%d')
+    filters = [f"(pred.transactiondate between '{start_date}' AND '{end_date}')",
+               '(prop.propertylandusetypeid IN (260, 261, 262, 263, 264, '
+               '268, 269, 273, 274, 275, 276, 279))']
+    # Same rows clean_zillow keeps after dropna
+    filters += [f'({ZILLOW_EXPRESSIONS[col]} IS NOT NULL)' for col in ZILLOW_SCHEMA
+                if col not in ('county', 'tax_rate', 'bath_per_sqft')]
+    if fips is not None:
+        filters.append(f'(prop.fips = {int(fips)})')
+    if tax_value_cutoff is not None:
+        tax_value_cutoffs = tax_value_cutoff if np.ndim(tax_value_cutoff) else (None, tax_value_cutoff)
+        filters += _bound_filters('prop.taxvaluedollarcnt', *tax_value_cutoffs)
+    if square_feet_cutoffs is not None:
+        filters += _bound_filters('prop.calculatedfinishedsquarefeet', *square_feet_cutoffs)
+    where = '\n                    AND '.join(filters)
+
+    return f'''SELECT {select}
+            FROM properties_2017 as prop
+            JOIN predictions_2017 as pred USING(parcelid)
+            JOIN propertylandusetype as proptype USING(propertylandusetypeid)
+            WHERE {where};
+                '''
+
+def get_prepared_zillow_data(features=PREPARED_FEATURES, start_date='2017-05-01', end_date='2017-08-31',
+                             fips=None, tax_value_cutoff=None, square_feet_cutoffs=None, iqr_filter=None,
+                             con=None):
+    '''
+    This function reads the requested zillow features from the CodeUp db with the
+    cleaning done in the db (see build_zillow_query) and returns a dataframe
+    indexed by parcelid.
+
+    Without cutoffs the rows are those of prepare.clean_zillow, not prepare_zillow:
+    the IQR outlier cutoffs depend on the quartiles of the cleaned rows, so they
+    cannot be computed inside the same query. Pass them as tax_value_cutoff and
+    square_feet_cutoffs, or pass a fitted sketch.IQRFilter as iqr_filter and both
+    bounds of its cutoffs_ are applied, giving the rows its transform keeps. An IQRFilter(columns={'taxvaluedollarcnt': (3, False)})
+    fit on the cleaned rows gives the rows of prepare_zillow.
+    '''
+    if iqr_filter is not None:
+        cutoffs = dict(iqr_filter.cutoffs_)
+        if 'taxvaluedollarcnt' in cutoffs:
+            tax_value_cutoff = cutoffs.pop('taxvaluedollarcnt')
+        if 'calculatedfinishedsquarefeet' in cutoffs:
+            square_feet_cutoffs = cutoffs.pop('calculatedfinishedsquarefeet')
+        if cutoffs:
+            raise ValueError(f'IQR cutoffs that cannot be applied in the db: {list(cutoffs)}')
+    if con is None:
+        con = get_engine('zillow')
+    sql_query = build_zillow_query(features, start_date, end_date, fips=fips,
+                                   tax_value_cutoff=tax_value_cutoff,
+                                   square_feet_cutoffs=square_feet_cutoffs)
+    df = set_zillow_dtypes(pd.read_sql(sql_query, con))
+
+    return df.set_index('parcelid')
+
+
+# Cache helpers
+def get_query_hash(sql_query):
+    '''
+    This function takes in a sql query and returns a sha256 hash of it with
+    whitespace normalized, so reformatting the query does not invalidate the cache.
+    '''
+    normalized = ' '.join(sql_query.split())
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+def get_manifest_filename(filename):
+    '''
+    This function takes in the filename of a cache file and returns the
+    filename of the json manifest that sits next to it.
+    '''
+    return os.path.splitext(filename)[0] + '.manifest.json'
+
+def read_manifest(filename):
+    '''
+    This function reads the manifest for the cache file and returns it as a dict.
+    It returns None if there is no manifest.
+    '''
+    manifest_file = get_manifest_filename(filename)
+    if not os.path.isfile(manifest_file):
+        return None
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def write_manifest(filename, manifest):
+    '''
+    This function writes the manifest dict for the cache file to json.
+    '''
+    with open(get_manifest_filename(filename), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+def write_cache(df, filename, sql_query=ZILLOW_QUERY, **manifest_fields):
+    '''
+    This function writes a zillow dataframe to a parquet cache file along with
+    a manifest holding the query hash, row count, schema and fetch time.
+    Any extra keyword arguments are stored in the manifest as well.
+    It returns the manifest.
+    '''
+    df.to_parquet(filename, index=False)
+    manifest = {
+        'query_hash': get_query_hash(sql_query),
+        'rows': int(len(df)),
+        'fetched_at': datetime.now(timezone.utc).isoformat(),
+        'schema': {col: str(dtype) for col, dtype in df.dtypes.items()},
+        **manifest_fields,
+    }
+    write_manifest(filename, manifest)
+    return manifest
+
+def cache_is_fresh(filename, sql_query=ZILLOW_QUERY, max_age=None):
+    '''
+    This function checks whether the cache file can be used for the given query.
+    The cache is stale if the file or manifest is missing, the query hash has changed,
+    the row count in the file does not match the manifest, or it is older than
+    max_age (a pd.Timedelta or a string like '1D').
+    '''
+    import pyarrow.parquet as pq
+
+    manifest = read_manifest(filename)
+    if manifest is None or not os.path.isfile(filename):
+        return False
+    if manifest['query_hash'] != get_query_hash(sql_query):
+        return False
+    if pq.read_metadata(filename).num_rows != manifest['rows']:
+        return False
+    if max_age is not None:
+        age = pd.Timestamp.now(tz='UTC') - pd.Timestamp(manifest['fetched_at'])
+        if age > pd.Timedelta(max_age):
+            return False
+    return True
+
+def read_cache(filename, columns=None):
+    '''
+    This function reads the parquet cache file into a dataframe. Passing a list of
+    columns only loads those columns from disk.
+    '''
+    df = pd.read_parquet(filename, columns=columns)
+    return set_zillow_dtypes(df)
+
+
+# Acquire Data
+def get_zillow_data(cached=False, columns=None, filename='zillow.parquet', max_age=None):
+    '''
+    This function reads in zillow data from Codeup database and caches it
+    as a parquet file with a json manifest next to it. 
+
+    If cached is True and the cache is still fresh (see cache_is_fresh) the data
+    is read from the cache instead of the database. Passing a list of columns
+    returns only those columns.
+    '''
+    if cached == False or cache_is_fresh(filename, max_age=max_age) == False:
         df = new_zillow_data()
-        df.to_csv(filename)
+        write_cache(df, filename)
+        if columns is not None:
+            df = df[columns]
     else:
-        df = pd.read_csv(filename, index_col=0)
-      
+        df = read_cache(filename, columns=columns)
    
-    return df
\ No newline at end of file
+    return df
+
+
+def update_zillow_data(filename='zillow_incremental.parquet', start_date='2017-05-01', con=None):
+    '''
+    This function refreshes a local zillow cache incrementally. It keeps a high-water
+    mark for pred.transactiondate in the cache manifest, fetches only transactions
+    on or after that mark, and upserts them into the cache keyed by parcelid (the
+    latest transaction for a parcel wins). Each increment is recorded in the manifest.
+    The mark is a date, so the day of the mark is fetched again: transactions added
+    for that day after the last refresh are not missed, and the rows fetched twice
+    are upserted to the same values.
+
+    If there is no cache yet, or it was built from a different query or start_date,
+    everything since start_date is fetched. It returns the updated dataframe.
+    '''
+    if con is None:
+        con = get_engine('zillow')
+
+    # The cache covers an open-ended window from start_date, so the hash is taken over that
+    sql_query = get_zillow_query(start_date, '9999-12-31')
+    manifest = read_manifest(filename)
+    if manifest is None or not cache_is_fresh(filename, sql_query) or 'watermark' not in manifest:
+        cached, watermark, increments = None, None, []
+    else:
+        cached, watermark, increments = read_cache(filename), manifest['watermark'], manifest['increments']
+
+    since = watermark if watermark is not None else start_date
+    new = pd.read_sql(get_zillow_query(start_date, '9999-12-31', since=since), con)
+    new['transactiondate'] = pd.to_datetime(new['transactiondate'])
+
+    # Keep only the latest transaction for each parcel before upserting
+    new = new.sort_values('transactiondate', kind='mergesort')
+    if len(new) > 0:
+        watermark = new['transactiondate'].max().strftime('%Y-%m-%d')
+    new = new.drop_duplicates('parcelid', keep='last').drop(columns=['transactiondate'])
+    new = set_zillow_dtypes(new)
+
+    if cached is None:
+        df = new
+    else:
+        df = pd.concat([cached[~cached.parcelid.isin(new.parcelid)], new], ignore_index=True)
+    df = df.sort_values('parcelid', kind='mergesort', ignore_index=True)
+
+    increments.append({
+        'fetched_at': datetime.now(timezone.utc).isoformat(),
+        'since': pd.Timestamp(since).strftime('%Y-%m-%d'),
+        'watermark': watermark,
+        'rows_fetched': int(len(new)),
+        'rows': int(len(df)),
+    })
+    write_cache(df, filename, sql_query, watermark=watermark, increments=increments)
+
+    return df
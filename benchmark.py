@@ -0,0 +1,246 @@
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+
+import acquire
+import prepare
+import preprocess
+import evaluate
+import synthetic
+from instrument import measure, emit, suspended
+
+def time_it(func, *args, repeat=3, **kwargs):
+    '''
+    This function calls func repeat times and returns the best wall time in
+    seconds along with the result of the last call.
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+### Coordinates
+
+def lambda_latitude(df):
+    '''
+    The original row-by-row latitude formatting from prepare.get_latitude,
+    kept as the reference for benchmark_coordinates.
+    '''
+    df.latitude = df.latitude.astype(int)
+    df['latitude'] = df['latitude'].apply(lambda x: x / 10 ** (len((str(x))) - 2))
+    return df
+
+def lambda_longitude(df):
+    '''
+    The original row-by-row longitude formatting from prepare.get_longitude,
+    kept as the reference for benchmark_coordinates.
+    '''
+    df.longitude = df.longitude.astype(int)
+    df['longitude'] = df['longitude'].apply(lambda x: x / 10 ** (len((str(x))) - 4))
+    return df
+
+def make_coordinates(n, seed=123):
+    '''
+    This function returns a dataframe of n raw zillow style coordinates. Most rows
+    look like the real data (34144442.0, -118654084.0) but some have fewer or more
+    digits, fractional parts, zeros and positive longitudes to cover the edge cases.
+    '''
+    rng = np.random.default_rng(seed)
+    latitude = rng.integers(33_300_000, 34_800_000, n).astype(float)
+    longitude = -rng.integers(117_500_000, 119_500_000, n).astype(float)
+
+    odd = rng.random(n) < 0.05
+    latitude[odd] = rng.integers(-10 ** 9, 10 ** 9, odd.sum()) / 10 ** rng.integers(0, 9, odd.sum())
+    longitude[odd] = rng.integers(-10 ** 9, 10 ** 9, odd.sum()) / 10 ** rng.integers(0, 9, odd.sum())
+    latitude[:3] = [0.0, 7.9, -5.2]
+    longitude[:3] = [0.0, -9.9, 123.0]
+
+    return pd.DataFrame({'latitude': latitude, 'longitude': longitude})
+
+def benchmark_coordinates(n=1_000_000, repeat=3, seed=123):
+    '''
+    This function checks that prepare.get_latitude and prepare.get_longitude give
+    exactly the same values as the original lambdas on n rows, then times both.
+    It returns a dataframe with the time in seconds and rows per second of each.
+    '''
+    df = make_coordinates(n, seed)
+
+    expected = lambda_longitude(lambda_latitude(df.copy()))
+    result = prepare.get_longitude(prepare.get_latitude(df.copy()))
+    for col in ['latitude', 'longitude']:
+        if not np.array_equal(expected[col].to_numpy(), result[col].to_numpy()):
+            raise AssertionError(f'vectorized {col} does not match the lambda version')
+
+    in_place = df.to_numpy(dtype=np.float64, copy=True)
+    prepare.normalize_coordinates(in_place[:, 0], 2, out=in_place[:, 0])
+    if not np.array_equal(in_place[:, 0], expected['latitude'].to_numpy()):
+        raise AssertionError('in place latitude does not match the lambda version')
+
+    timings = {
+        'lambda': time_it(lambda: lambda_longitude(lambda_latitude(df.copy())), repeat=repeat)[0],
+        'vectorized': time_it(lambda: prepare.get_longitude(prepare.get_latitude(df.copy())), repeat=repeat)[0],
+    }
+    report = pd.DataFrame({'seconds': timings})
+    report['rows_per_second'] = n / report.seconds
+    return report
+
+
+### Metrics
+
+def legacy_regression_errors(actual, predicted):
+    '''
+    The original evaluate.regression_errors, calling each metric function
+    separately, kept as the reference for benchmark_metrics.
+    '''
+    return pd.Series({
+        'sse': evaluate.sse(actual, predicted),
+        'ess': evaluate.ess(actual, predicted),
+        'tss': evaluate.tss(actual),
+        'mse': evaluate.mse(actual, predicted),
+        'rmse': evaluate.rmse(actual, predicted),
+        'r^2': (evaluate.ess(actual, predicted))/(evaluate.tss(actual)),
+    })
+
+def benchmark_metrics(n=10_000_000, repeat=3, seed=123):
+    '''
+    This function checks that evaluate.regression_errors matches the original
+    per-metric implementation to within 1e-9 relative tolerance on n rows of
+    property value like data, then times both.
+    It returns a dataframe with the time in seconds and rows per second of each.
+    '''
+    rng = np.random.default_rng(seed)
+    actual = pd.Series(rng.lognormal(12.8, 0.7, n))
+    predicted = actual * rng.normal(1, 0.3, n) + rng.normal(0, 50_000, n)
+
+    expected = legacy_regression_errors(actual, predicted)
+    result = evaluate.regression_errors(actual, predicted)
+    if not np.allclose(result.to_numpy(), expected.to_numpy(), rtol=1e-9, atol=0):
+        raise AssertionError(f'regression_errors does not match:\n{pd.concat([expected, result], axis=1)}')
+
+    timings = {
+        'per_metric': time_it(legacy_regression_errors, actual, predicted, repeat=repeat)[0],
+        'regression_errors': time_it(evaluate.regression_errors, actual, predicted, repeat=repeat)[0],
+        'regression_metrics': time_it(evaluate.regression_metrics, actual.to_numpy(), predicted.to_numpy(),
+                                      repeat=repeat)[0],
+    }
+    report = pd.DataFrame({'seconds': timings})
+    report['rows_per_second'] = n / report.seconds
+    return report
+
+
+### Imports
+
+# Heavy or environment dependent modules that importing each module must not load;
+# they are imported on first use by the functions that need them
+HEAVY_MODULES = ['pandas', 'matplotlib', 'seaborn', 'scipy', 'sklearn', 'statsmodels', 'sqlalchemy', 'env']
+IMPORT_GUARDS = {
+    'score': HEAVY_MODULES,
+    'evaluate': HEAVY_MODULES,
+    'acquire': HEAVY_MODULES[1:],
+    'prepare': HEAVY_MODULES[1:],
+    'preprocess': HEAVY_MODULES[1:],
+    'explore': HEAVY_MODULES[1:],
+    'pipeline': HEAVY_MODULES[1:],
+    'modeling': HEAVY_MODULES[1:],
+}
+
+def import_time(module):
+    '''
+    This function imports module in a fresh interpreter with -X importtime and
+    returns its cumulative import time in milliseconds and the set of top level
+    packages that were loaded.
+    '''
+    code = f'import sys, {module}; print(" ".join(sys.modules))'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, check=True)
+    cumulative = next(int(line.split('|')[1]) for line in reversed(result.stderr.splitlines())
+                      if line.startswith('import time:') and line.split('|')[2].strip() == module)
+    loaded = {name.split('.')[0] for name in result.stdout.split()}
+    return cumulative / 1000, loaded
+
+def benchmark_imports(guards=IMPORT_GUARDS, repeat=3):
+    '''
+    This function checks that importing each module in guards does not load any
+    of the modules listed for it, then reports the best import time of each in
+    milliseconds (each import runs in a new interpreter, so nothing is cached).
+    '''
+    timings = {}
+    for module, forbidden in guards.items():
+        best = float('inf')
+        for _ in range(repeat):
+            milliseconds, loaded = import_time(module)
+            best = min(best, milliseconds)
+        heavy = sorted(loaded.intersection(forbidden))
+        if heavy:
+            raise AssertionError(f'importing {module} loads {", ".join(heavy)}')
+        timings[module] = best
+    return pd.DataFrame({'import_ms': timings})
+
+
+### Pipeline stages
+
+def benchmark_stages(sizes=(25_000, 250_000, 2_500_000), seed=123, chunk_size=1_000_000):
+    '''
+    This function runs the pipeline end to end on synthetic data of each size (the
+    number of parcels in the db) and measures every stage: building the SQLite
+    stand-in, acquire.new_zillow_data from it, prepare.clean_zillow,
+    prepare.prepare_zillow, preprocess.min_max_scale on the split and
+    evaluate.regression_errors of the mean baseline.
+    It returns a dataframe with the rows, seconds, rows per second and peak RSS
+    (MB) of each stage and size. With ZILLOW_INSTRUMENT set, every record is also
+    emitted once at the end.
+    '''
+    records = []
+    # The stages are measured here, so the hooks inside them are turned off and
+    # each stage is emitted once, from its record below
+    with suspended() as destination:
+        for size in sizes:
+            with tempfile.TemporaryDirectory() as directory:
+                with measure('synthetic.populate_sqlite', size, size=size) as record:
+                    con = synthetic.populate_sqlite(os.path.join(directory, 'zillow.db'), size,
+                                                    chunk_size=chunk_size, seed=seed)
+                records.append(record)
+
+                with measure('acquire.new_zillow_data', size=size) as record:
+                    df = acquire.new_zillow_data(con=con)
+                    record['rows'] = len(df)
+                records.append(record)
+
+            with measure('prepare.clean_zillow', len(df), size=size) as record:
+                prepare.clean_zillow(df)
+            records.append(record)
+
+            with measure('prepare.prepare_zillow', len(df), size=size) as record:
+                prepared = prepare.prepare_zillow(df)
+            records.append(record)
+
+            X, y = prepared.drop(columns='taxvaluedollarcnt'), prepared['taxvaluedollarcnt']
+            train, validate, test = preprocess.split_indices(y)
+            with measure('preprocess.min_max_scale', len(X), size=size) as record:
+                preprocess.min_max_scale(X.iloc[train], X.iloc[validate], X.iloc[test], X.columns.tolist())
+            records.append(record)
+
+            with measure('evaluate.regression_errors', len(y), size=size) as record:
+                evaluate.regression_errors(y, np.full(len(y), y.mean()))
+            records.append(record)
+            del df, prepared, X, y
+
+    if destination is not None:
+        for record in records:
+            emit(record)
+
+    columns = ['size', 'stage', 'rows', 'seconds', 'rows_per_second', 'peak_rss_mb']
+    return pd.DataFrame(records)[columns]
+
+
+if __name__ == '__main__':
+    print(benchmark_imports())
+    print(benchmark_stages())
+    print(benchmark_coordinates())
+    print(benchmark_metrics())
@@ -0,0 +1,30 @@
+'''
+Coordinate formatting shared by prepare (dataframes) and score (numpy only), so
+training and scoring always format latitude and longitude the same way. Only
+numpy is imported.
+'''
+import numpy as np
+
+# Powers of ten used to count the digits of the integer part of a coordinate
+_POWERS_OF_TEN = 10.0 ** np.arange(1, 19)
+
+def normalize_coordinates(values, int_digits, out=None):
+    '''
+    This function takes in an array of coordinates stored without a decimal point
+    (e.g. 34144442 for 34.144442) and returns them with int_digits digits
+    before the decimal point, counting a minus sign as a digit like the
+    original str(x) based lambda did. The values are truncated to integers first.
+
+    It is fully vectorized. Pass out=values to work in place on a float64 or
+    float32 array.
+    '''
+    values = np.asarray(values)
+    if out is None:
+        out = np.empty(values.shape, dtype=np.float64)
+    np.trunc(values, out=out)
+
+    # len(str(x)) == number of digits of |x| (at least 1) plus one for a minus sign
+    digits = np.searchsorted(_POWERS_OF_TEN, np.abs(out), side='right') + 1
+    digits += out < 0
+    out /= 10.0 ** (digits - int_digits)
+    return out
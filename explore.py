@@ -1,10 +1,15 @@
+'''
+Exploration helpers. matplotlib and scipy are imported by the functions that plot
+or test, so importing this module stays fast.
+
+The univariate plots and tables are drawn from a DataProfile: small summaries of
+every column built in one chunked pass, which can be saved and reused.
+'''
+import json
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-from sklearn.model_selection import train_test_split
-from scipy import stats
-from env import host, user, password
+
+from sketch import QuantileSketch
 
 def get_object_cols(df):
     '''
@@ -26,48 +31,242 @@ def get_numeric_cols(train, obj_cols):
     
     return numeric_cols
 
-def explore_univariate(train, cat_vars, quant_vars):
+def explore_univariate(train, cat_vars, quant_vars, profile=None):
     '''
     This function takes in a  dataframe and plots historgrams for univariate
     features. This is designed to be used to explore the data.
+    All plots and tables are drawn from one DataProfile pass over train, or from
+    profile if one is given.
     '''
+    import matplotlib.pyplot as plt
+
+    if profile is None:
+        profile = DataProfile(categorical=cat_vars).fit(train[list(cat_vars) + list(quant_vars)])
     for var in cat_vars:
-        explore_univariate_categorical(train, var)
+        explore_univariate_categorical(train, var, profile)
         print('_________________________________________________________________')
     for col in quant_vars:
-        p, descriptive_stats = explore_univariate_quant(train, col)
+        p, descriptive_stats = explore_univariate_quant(train, col, profile)
         plt.show(p)
         print(descriptive_stats)
         
+### Profiling
+
+class DataProfile:
+    '''
+    One-pass summaries of every column of a dataframe or of an iterable of chunks:
+
+        - numeric columns: count, missing, mean and std (merged chunk by chunk),
+          min, max and a QuantileSketch for the quartiles, box plot statistics
+          and histogram
+        - other columns, and numeric ones listed in categorical: value counts
+
+    describe, histogram, box_stats and freq_table answer from the summaries, so
+    every plot of an extract costs one scan in total. The summaries are small:
+    save writes them to json and load reads them back without touching the data.
+
+    fit on an in-memory dataframe sizes each sketch to the frame, so quantiles,
+    histogram counts and box plot statistics are exact (the same as describe(),
+    np.histogram and plt.boxplot). Streamed chunks keep sketches of sketch_k values,
+    which are exact until a column has more than sketch_k values and close
+    estimates after that.
+    '''
+    def __init__(self, bins=10, categorical=None, sketch_k=1000):
+        self.bins = bins
+        self.categorical = set([] if categorical is None else categorical)
+        self.sketch_k = sketch_k
+        self.numeric = {}
+        self.counts = {}
+        self._summary = None
+
+    def partial_fit(self, chunk):
+        '''
+        This method adds one chunk of rows to the summaries.
+        '''
+        self._summary = None
+        for col in chunk.columns:
+            values = chunk[col]
+            if (col in self.categorical or not pd.api.types.is_numeric_dtype(values)
+                    or pd.api.types.is_bool_dtype(values)):
+                counts = values.value_counts()
+                self.counts[col] = counts if col not in self.counts else self.counts[col].add(counts, fill_value=0)
+                continue
+
+            values = values.to_numpy(dtype=np.float64)
+            present = values[~np.isnan(values)]
+            state = self.numeric.setdefault(col, {'n': 0, 'missing': 0, 'mean': 0.0, 'm2': 0.0,
+                                                  'min': np.inf, 'max': -np.inf,
+                                                  'sketch': QuantileSketch(self.sketch_k)})
+            state['missing'] += len(values) - len(present)
+            if len(present) == 0:
+                continue
+            # Merge the chunk's mean and sum of squared deviations (Chan et al.)
+            n_b, mean_b = len(present), present.mean()
+            n = state['n'] + n_b
+            delta = mean_b - state['mean']
+            state['m2'] += ((present - mean_b) ** 2).sum() + delta ** 2 * state['n'] * n_b / n
+            state['mean'] += delta * n_b / n
+            state['n'] = n
+            state['min'] = min(state['min'], present.min())
+            state['max'] = max(state['max'], present.max())
+            state['sketch'].update(present)
+        return self
+
+    def fit(self, data):
+        '''
+        This method summarizes a dataframe exactly, or an iterable of chunks in one
+        pass with memory bounded by the sketches.
+        '''
+        if isinstance(data, pd.DataFrame):
+            # The frame is already in memory, so the sketches may hold all of it
+            sketch_k, self.sketch_k = self.sketch_k, max(self.sketch_k, len(data))
+            try:
+                return self.partial_fit(data)
+            finally:
+                self.sketch_k = sketch_k
+        for chunk in data:
+            self.partial_fit(chunk)
+        return self
+
+    def _numeric_summary(self, state):
+        n, sketch = state['n'], state['sketch']
+        if n == 0:
+            nan = float('nan')
+            return {'count': 0, 'missing': state['missing'], 'mean': nan, 'std': nan, 'min': nan,
+                    '25%': nan, '50%': nan, '75%': nan, 'max': nan,
+                    'histogram': {'counts': [], 'edges': []}, 'box': None}
+
+        q1, median, q3 = sketch.quantile([.25, .5, .75])
+        counts, edges = sketch.histogram(self.bins, (state['min'], state['max']))
+
+        # Whiskers at the furthest values within 1.5 iqr of the quartiles, as in
+        # plt.boxplot; the values the sketch holds beyond them stand in for the fliers
+        items, _ = sketch.weighted_items()
+        low, high = q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
+        whislo = state['min'] if state['min'] >= low else np.min(items[items >= low], initial=q1)
+        whishi = state['max'] if state['max'] <= high else np.max(items[items <= high], initial=q3)
+        fliers = np.unique(np.concatenate([items[(items < whislo) | (items > whishi)],
+                                           [value for value in (state['min'], state['max'])
+                                            if value < whislo or value > whishi]]))
+        return {
+            'count': n,
+            'missing': state['missing'],
+            'mean': state['mean'],
+            'std': np.sqrt(state['m2'] / (n - 1)) if n > 1 else float('nan'),
+            'min': state['min'],
+            '25%': q1,
+            '50%': median,
+            '75%': q3,
+            'max': state['max'],
+            'histogram': {'counts': counts.tolist(), 'edges': edges.tolist()},
+            'box': {'whislo': whislo, 'q1': q1, 'med': median, 'q3': q3, 'whishi': whishi,
+                    'mean': state['mean'], 'fliers': fliers.tolist()},
+        }
+
+    def summary(self):
+        '''
+        This method returns the finished summaries as a dict of plain python values.
+        '''
+        if self._summary is None:
+            numeric = {col: self._numeric_summary(state) for col, state in self.numeric.items()}
+            categorical = {}
+            for col, counts in self.counts.items():
+                counts = counts.sort_values(ascending=False, kind='stable')
+                categorical[col] = {'values': counts.index.tolist(), 'counts': counts.astype('int64').tolist()}
+            self._summary = json.loads(json.dumps({'bins': self.bins, 'numeric': numeric,
+                                                   'categorical': categorical}, default=float))
+        return self._summary
+
+    def describe(self):
+        '''
+        This method returns a dataframe like df.describe() for the numeric columns.
+        '''
+        rows = ['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
+        numeric = self.summary()['numeric']
+        return pd.DataFrame({col: [float(stats[row]) for row in rows] for col, stats in numeric.items()},
+                            index=rows)
+
+    def histogram(self, col):
+        '''
+        This method returns the counts and bin edges of a numeric column.
+        '''
+        histogram = self.summary()['numeric'][col]['histogram']
+        return np.array(histogram['counts']), np.array(histogram['edges'])
+
+    def box_stats(self, col):
+        '''
+        This method returns the box plot statistics of a numeric column as a dict
+        for matplotlib's Axes.bxp.
+        '''
+        return dict(self.summary()['numeric'][col]['box'], label=col)
+
+    def freq_table(self, col):
+        '''
+        This method returns the same frequency table as freq_table(train, col).
+        '''
+        categorical = self.summary()['categorical'][col]
+        counts = pd.Series(categorical['counts'], index=pd.Index(categorical['values'], name=col), name='count')
+        return pd.DataFrame({col: counts.index, 'Count': counts,
+                             'Percent': round(counts / counts.sum() * 100, 2)})
+
+    def save(self, filename):
+        '''
+        This method writes the summaries to a json file.
+        '''
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        This method reads summaries written by save. The profile can be used for
+        plots and tables right away, without the data.
+        '''
+        with open(filename) as f:
+            summary = json.load(f)
+        profile = cls(bins=summary['bins'])
+        profile._summary = summary
+        return profile
+
 ### Univariate
 
-def explore_univariate_categorical(train, cat_var):
+def explore_univariate_categorical(train, cat_var, profile=None):
     '''
     takes in a dataframe and a categorical variable and returns
     a frequency table and barplot of the frequencies. 
+    With a DataProfile the table is read from its summaries instead of train.
     '''
-    frequency_table = freq_table(train, cat_var)
+    import matplotlib.pyplot as plt
+
+    frequency_table = freq_table(train, cat_var) if profile is None else profile.freq_table(cat_var)
     plt.figure(figsize=(2,2))
-    sns.barplot(x=cat_var, y='Count', data=frequency_table, color='lightblue', edgecolor='grey')
+    plt.bar(frequency_table[cat_var].astype(str), frequency_table['Count'], color='lightblue', edgecolor='grey')
     plt.title(cat_var)
     plt.show()
     print(frequency_table)
 
-def explore_univariate_quant(train, quant_var):
+def explore_univariate_quant(train, quant_var, profile=None):
     '''
     takes in a dataframe and a quantitative variable and returns
     descriptive stats table, histogram, and boxplot of the distributions. 
+    The plots are drawn from the summaries of a DataProfile (built from train
+    if none is given), not from every row.
     '''
-    descriptive_stats = train[quant_var].describe()
+    import matplotlib.pyplot as plt
+
+    if profile is None:
+        profile = DataProfile().fit(train[[quant_var]])
+    descriptive_stats = profile.describe()[quant_var]
     plt.figure(figsize=(8,2))
 
     p = plt.subplot(1, 2, 1)
-    p = plt.hist(train[quant_var], color='lightblue', edgecolor='grey')
+    counts, edges = profile.histogram(quant_var)
+    p = plt.bar(edges[:-1], counts, width=np.diff(edges), align='edge', color='lightblue', edgecolor='grey')
     p = plt.title(quant_var)
 
     # second plot: box plot
     p = plt.subplot(1, 2, 2)
-    p = plt.boxplot(train[quant_var])
+    p = p.bxp([profile.box_stats(quant_var)], showmeans=False)
     p = plt.title(quant_var)
     return p, descriptive_stats
     
@@ -76,17 +275,227 @@ def freq_table(train, cat_var):
     for a given categorical variable, compute the frequency count and percent split
     and return a dataframe of those values along with the different classes. 
     '''
-    class_labels = list(train[cat_var].unique())
+    # One value_counts gives both the counts and the percents, with the labels
+    # lined up with their counts
+    counts = train[cat_var].value_counts()
 
     frequency_table = (
-        pd.DataFrame({cat_var: class_labels,
-                      'Count': train[cat_var].value_counts(normalize=False), 
-                      'Percent': round(train[cat_var].value_counts(normalize=True)*100,2)}
+        pd.DataFrame({cat_var: counts.index,
+                      'Count': counts, 
+                      'Percent': round(counts / counts.sum() * 100, 2)}
                     )
     )
     return frequency_table
 
 def compare_means(train, target, quant_var, alt_hyp='two-sided'):
+    from scipy import stats
+
     x = train[train[target]==0][quant_var]
     y = train[train[target]==1][quant_var]
-    return stats.mannwhitneyu(x, y, use_continuity=True, alternative=alt_hyp)
\ No newline at end of file
+    return stats.mannwhitneyu(x, y, use_continuity=True, alternative=alt_hyp)
+### Hypothesis tests
+
+# Tests run by hypothesis_tests: the first two compare each group with the rest,
+# the last two correlate each feature with the target
+HYPOTHESIS_TESTS = ('mannwhitneyu', 'welch_t', 'pearson', 'spearman')
+
+def _rank_columns(X):
+    '''
+    Returns the average ranks (1-based, as scipy's rankdata) of every column of X,
+    with NaN left as NaN, and the tie term sum(t ** 3 - t) of each column. Each
+    column is sorted once for both.
+    '''
+    # Sorting rows of the transpose keeps each column contiguous
+    columns = np.ascontiguousarray(X.T)
+    order = np.argsort(columns, axis=1)
+    ordered = np.take_along_axis(columns, order, axis=1)
+    counts_valid = (~np.isnan(columns)).sum(axis=1)
+    ranks = np.full(columns.shape, np.nan)
+    ties = np.zeros(len(columns))
+    for j, n in enumerate(counts_valid):
+        values = ordered[j, :n]
+        starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+        counts = np.diff(np.r_[starts, n])
+        ranks[j, order[j, :n]] = np.repeat(starts + (counts + 1) / 2, counts)
+        ties[j] = (counts.astype(np.float64) ** 3 - counts).sum()
+    return ranks.T, ties
+
+def _p_value(distribution, statistic, alternative, *args):
+    if alternative == 'greater':
+        return distribution.sf(statistic, *args)
+    if alternative == 'less':
+        return distribution.cdf(statistic, *args)
+    return np.minimum(2 * distribution.sf(np.abs(statistic), *args), 1)
+
+def _correlation(a, b, valid):
+    '''
+    Returns the correlation of every column of a with the same column of b over the
+    rows where valid, and the number of those rows.
+    '''
+    n = valid.sum(axis=0)
+    a, b = np.where(valid, a, 0.0), np.where(valid, b, 0.0)
+    a = np.where(valid, a - a.sum(axis=0) / n, 0.0)
+    b = np.where(valid, b - b.sum(axis=0) / n, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (a * b).sum(axis=0) / np.sqrt((a * a).sum(axis=0) * (b * b).sum(axis=0)), n
+
+def _test_block(X, features, codes, groups, y, tests, alternative):
+    '''
+    Runs the tests for a block of feature columns X (rows x features) at once and
+    returns the results as a list of dicts. codes is the group of each row (-1 for
+    none) and y the target.
+    '''
+    from scipy import stats
+
+    # Every column (and the target) is ranked once over all rows; the ranks are
+    # only recomputed for columns where a test has to leave some rows out
+    ranks = ties = None
+    if 'mannwhitneyu' in tests or 'spearman' in tests:
+        ranks, ties = _rank_columns(X if y is None else np.column_stack([X, y]))
+
+    results = []
+    def add(test, group, n, statistic, p_value):
+        for j, feature in enumerate(features):
+            results.append({'feature': feature, 'test': test, 'group': group,
+                            'n': int(n[j]), 'statistic': statistic[j], 'p_value': p_value[j]})
+
+    if groups is not None and {'mannwhitneyu', 'welch_t'} & set(tests):
+        in_group = codes >= 0
+        Xg = X[in_group]
+        valid = ~np.isnan(Xg)
+        # Rows x groups indicator, so every group's sums come from one product
+        indicator = (codes[in_group, np.newaxis] == np.arange(len(groups))).astype(np.float64)
+        n = valid.sum(axis=0)
+        n1 = indicator.T @ valid
+        n2 = n - n1
+
+        if 'mannwhitneyu' in tests:
+            group_ranks, group_ties = ranks[:, :X.shape[1]], ties[:X.shape[1]]
+            if not in_group.all():
+                group_ranks, group_ties = _rank_columns(Xg)
+            u1 = indicator.T @ np.where(valid, group_ranks, 0.0) - n1 * (n1 + 1) / 2
+            u2 = n1 * n2 - u1
+            u = {'greater': u1, 'less': u2}.get(alternative, np.maximum(u1, u2))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                # Normal approximation with tie and continuity correction, as scipy's
+                # mannwhitneyu(method='asymptotic', use_continuity=True)
+                sigma = np.sqrt(n1 * n2 / 12 * ((n + 1) - group_ties / (n * (n - 1))))
+                z = (u - n1 * n2 / 2 - 0.5) / sigma
+            p_value = np.clip(stats.norm.sf(z) * (1 if alternative in ('greater', 'less') else 2), 0, 1)
+            for g, group in enumerate(groups):
+                add('mannwhitneyu', group, n1[g], u1[g], p_value[g])
+
+        if 'welch_t' in tests:
+            # Centered first so the sums of squares keep their precision
+            centered = np.where(valid, Xg - np.nanmean(Xg, axis=0), 0.0)
+            sum1, sum_sq1 = indicator.T @ centered, indicator.T @ centered ** 2
+            sum2, sum_sq2 = centered.sum(axis=0) - sum1, (centered ** 2).sum(axis=0) - sum_sq1
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean1, mean2 = sum1 / n1, sum2 / n2
+                var1 = (sum_sq1 - n1 * mean1 ** 2) / (n1 - 1) / n1
+                var2 = (sum_sq2 - n2 * mean2 ** 2) / (n2 - 1) / n2
+                t = (mean1 - mean2) / np.sqrt(var1 + var2)
+                df = (var1 + var2) ** 2 / (var1 ** 2 / (n1 - 1) + var2 ** 2 / (n2 - 1))
+            p_value = _p_value(stats.t, t, alternative, df)
+            for g, group in enumerate(groups):
+                add('welch_t', group, n1[g], t[g], p_value[g])
+
+    if y is not None and {'pearson', 'spearman'} & set(tests):
+        valid = ~np.isnan(X) & ~np.isnan(y)[:, np.newaxis]
+        r_values = {}
+        if 'pearson' in tests:
+            r_values['pearson'] = _correlation(X, np.broadcast_to(y[:, np.newaxis], X.shape), valid)
+        if 'spearman' in tests:
+            # Columns whose complete pairs are not all of their values (or all of
+            # the target's) are ranked again on those pairs
+            rank_x, rank_y = ranks[:, :-1].copy(), np.repeat(ranks[:, -1:], X.shape[1], axis=1)
+            repair = (valid != ~np.isnan(X)).any(axis=0) | (valid != ~np.isnan(y)[:, np.newaxis]).any(axis=0)
+            for j in np.flatnonzero(repair):
+                rows = valid[:, j]
+                pair_ranks, _ = _rank_columns(np.column_stack([X[rows, j], y[rows]]))
+                rank_x[rows, j], rank_y[rows, j] = pair_ranks[:, 0], pair_ranks[:, 1]
+            r_values['spearman'] = _correlation(rank_x, rank_y, valid)
+        for test, (r, n) in r_values.items():
+            with np.errstate(invalid='ignore', divide='ignore'):
+                t = r * np.sqrt((n - 2) / (1 - r ** 2))
+            add(test, None, n, r, _p_value(stats.t, t, alternative, n - 2))
+    return results
+
+def adjust_p_values(p_values):
+    '''
+    This function returns the Bonferroni and Benjamini-Hochberg adjusted p-values
+    of an array of p-values. Missing p-values stay missing and do not count toward
+    the number of comparisons.
+    '''
+    p_values = np.asarray(p_values, dtype=np.float64)
+    tested = np.flatnonzero(~np.isnan(p_values))
+    bonferroni = np.full(len(p_values), np.nan)
+    benjamini_hochberg = np.full(len(p_values), np.nan)
+    m = len(tested)
+    if m:
+        bonferroni[tested] = np.minimum(p_values[tested] * m, 1)
+        order = tested[np.argsort(p_values[tested], kind='stable')]
+        stepped = p_values[order] * m / np.arange(1, m + 1)
+        benjamini_hochberg[order] = np.minimum(np.minimum.accumulate(stepped[::-1])[::-1], 1)
+    return bonferroni, benjamini_hochberg
+
+def hypothesis_tests(df, features, group=None, target='taxvaluedollarcnt', tests=HYPOTHESIS_TESTS,
+                     alternative='two-sided', alpha=0.05, n_jobs=1, block_size=64):
+    '''
+    This function runs many hypothesis tests at once and returns one tidy table:
+
+        - mannwhitneyu and welch_t compare each level of the group column with
+          all other rows, for every feature (with a two level group, such as the
+          0/1 target of compare_means, only the first level is compared with the
+          second). The statistic is U of the level's rows or Welch's t.
+        - pearson and spearman correlate every feature with target; the
+          statistic is r.
+
+    Every column is ranked once and each test is computed for all features and
+    groups together with matrix products. Features are split into blocks of
+    block_size columns, which run on n_jobs processes when n_jobs > 1.
+    Rows are sorted by test, group and feature (in the order of tests, the sorted
+    group levels and features), so tables from different block_size and n_jobs
+    settings line up row by row. The p-values get Bonferroni and Benjamini-Hochberg
+    corrections over the whole table, and reject_* columns flag the ones below alpha.
+    '''
+    features = [col for col in features if col != target and col != group]
+    X = df[features].to_numpy(dtype=np.float64)
+    y = df[target].to_numpy(dtype=np.float64) if target is not None else None
+
+    codes, groups = None, None
+    if group is not None:
+        codes, labels = pd.factorize(df[group], sort=True)
+        groups = labels.tolist()
+        if len(groups) == 2:
+            # The rest is the second level, so one comparison covers both
+            groups = groups[:1]
+
+    blocks = [slice(start, start + block_size) for start in range(0, len(features), block_size)]
+    args = [(X[:, block], features[block], codes, groups, y, tuple(tests), alternative) for block in blocks]
+    if n_jobs == 1:
+        results = [_test_block(*block_args) for block_args in args]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_test_block, *zip(*args)))
+
+    rows = [row for block in results for row in block]
+    table = pd.DataFrame(rows, columns=['feature', 'test', 'group', 'n', 'statistic', 'p_value'])
+    # Keep group labels as they are (not cast to float next to the missing ones)
+    table['group'] = pd.Series([row['group'] for row in rows], dtype=object)
+    # The same order whatever block_size and n_jobs are: by test, group and
+    # feature, each in the order given (group levels sorted)
+    position = {name: i for i, name in enumerate(tests)}
+    group_position = {label: i for i, label in enumerate(groups or [])}
+    feature_position = {name: i for i, name in enumerate(features)}
+    keys = pd.DataFrame({'test': table['test'].map(position),
+                         'group': [-1 if label is None else group_position[label] for label in table['group']],
+                         'feature': table['feature'].map(feature_position)})
+    table = table.iloc[keys.sort_values(['test', 'group', 'feature'], kind='mergesort').index]
+    table = table.reset_index(drop=True)
+    table['p_bonferroni'], table['p_bh'] = adjust_p_values(table['p_value'])
+    table['reject_bonferroni'] = table['p_bonferroni'] < alpha
+    table['reject_bh'] = table['p_bh'] < alpha
+    return table
@@ -0,0 +1,184 @@
+'''
+Opt-in per-stage instrumentation. Set ZILLOW_INSTRUMENT to a file path (or to
+"stderr") and every instrumented stage appends one json line there:
+
+    {"stage": "prepare.clean_zillow", "rows": 2500000, "seconds": 1.93,
+     "rows_per_second": 1295336.8, "rss_mb": 812.4, "peak_rss_mb": 1034.1, ...}
+
+When ZILLOW_INSTRUMENT is not set the hooks do nothing but one environment lookup.
+Only the standard library is imported, so instrumenting a module costs nothing
+at import time.
+'''
+import os
+import sys
+import json
+import time
+import inspect
+import functools
+import itertools
+from contextlib import contextmanager
+
+# Environment variable that turns the hooks on and says where records go
+INSTRUMENT_ENV = 'ZILLOW_INSTRUMENT'
+
+def enabled():
+    '''
+    This function returns True if the hooks are turned on.
+    '''
+    return bool(os.environ.get(INSTRUMENT_ENV))
+
+def _memory_mb():
+    '''
+    Returns the current and peak resident set size of this process in MB. The
+    peak comes from VmHWM on Linux (see reset_peak_memory) and from getrusage
+    elsewhere.
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            fields = dict(line.split(':', 1) for line in f)
+        return int(fields['VmRSS'].split()[0]) / 1024, int(fields['VmHWM'].split()[0]) / 1024
+    except (OSError, KeyError):
+        import resource
+
+        # ru_maxrss is in bytes on macOS and in kB elsewhere
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024
+        return float('nan'), peak
+
+def reset_peak_memory():
+    '''
+    This function resets the peak resident set size of the process to the current
+    one, so the next peak belongs to one stage. It returns False where that is not
+    supported (before Linux 4.0 and on other systems), in which case the peak is
+    the peak of the whole process so far.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+# Peaks seen by the stages that are open, innermost last. A nested stage resets
+# the peak, so it hands the peak so far to the stages around it first.
+_open_peaks = []
+
+@contextmanager
+def measure(name, rows=None, **fields):
+    '''
+    This context manager always measures the block it wraps and yields a dict
+    that holds the stage's record once the block exits: stage, rows, seconds,
+    rows_per_second, cpu_seconds, rss_mb (at exit), peak_rss_mb (during the block)
+    and any extra fields. rows can also be set on the dict inside the block.
+    '''
+    record = {'stage': name, 'rows': rows, **fields}
+    if _open_peaks:
+        peak = _memory_mb()[1]
+        _open_peaks[:] = [max(seen, peak) for seen in _open_peaks]
+    peak_is_stage = reset_peak_memory()
+    _open_peaks.append(0.0)
+    start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        seconds = time.perf_counter() - start
+        rss, peak = _memory_mb()
+        peak = max(peak, _open_peaks.pop())
+        rows = record['rows']
+        record.update({
+            'seconds': seconds,
+            'rows_per_second': rows / seconds if rows is not None and seconds > 0 else None,
+            'cpu_seconds': time.process_time() - cpu_start,
+            'rss_mb': rss,
+            'peak_rss_mb': peak,
+            'peak_is_stage': peak_is_stage,
+            'pid': os.getpid(),
+        })
+        if _open_peaks:
+            _open_peaks[:] = [max(seen, peak) for seen in _open_peaks]
+
+def emit(record):
+    '''
+    This function writes one record as a json line to the destination named by
+    ZILLOW_INSTRUMENT.
+    '''
+    line = json.dumps(record, default=str) + '\n'
+    destination = os.environ.get(INSTRUMENT_ENV)
+    if destination in ('stderr', '-', '1'):
+        sys.stderr.write(line)
+    else:
+        with open(destination, 'a') as f:
+            f.write(line)
+
+@contextmanager
+def stage(name, rows=None, **fields):
+    '''
+    This context manager measures and emits the block it wraps as one stage if the
+    hooks are turned on. It yields the record dict (None when turned off).
+    '''
+    if not enabled():
+        yield None
+        return
+    with measure(name, rows, **fields) as record:
+        yield record
+    emit(record)
+
+@contextmanager
+def suspended():
+    '''
+    This context manager turns the hooks off inside the block, for callers that
+    measure the stages themselves (see benchmark.benchmark_stages). It yields the
+    destination the hooks had, or None.
+    '''
+    destination = os.environ.pop(INSTRUMENT_ENV, None)
+    try:
+        yield destination
+    finally:
+        if destination is not None:
+            os.environ[INSTRUMENT_ENV] = destination
+
+def _instrumented_chunks(stage_name, chunks):
+    '''
+    Yields the chunks of a generator, making the production of each chunk a stage
+    (with its index as chunk and its length as rows).
+    '''
+    for index in itertools.count():
+        with measure(stage_name, chunk=index) as record:
+            chunk = next(chunks, None)
+            if hasattr(chunk, '__len__'):
+                record['rows'] = len(chunk)
+        if chunk is None:
+            return
+        emit(record)
+        yield chunk
+
+def instrumented(name=None):
+    '''
+    This decorator makes every call of a function a stage named name (module.function
+    by default). rows is the length of the first argument, or of the result when
+    the function has no sized first argument.
+
+    A function that returns a generator (such as acquire.stream_zillow_data) does
+    its work as the chunks are consumed, so the call is not a stage; each chunk is
+    one instead. A generator that is already instrumented is passed through.
+    '''
+    def decorate(func):
+        stage_name = name or f'{func.__module__}.{func.__name__}'
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            first = args[0] if args else None
+            with measure(stage_name, len(first) if hasattr(first, '__len__') else None) as record:
+                result = func(*args, **kwargs)
+                if record['rows'] is None and hasattr(result, '__len__'):
+                    record['rows'] = len(result)
+            if inspect.isgenerator(result):
+                if result.gi_code is _instrumented_chunks.__code__:
+                    return result
+                return _instrumented_chunks(stage_name, result)
+            emit(record)
+            return result
+        return wrapper
+    return decorate
@@ -0,0 +1,339 @@
+import os
+import json
+import itertools
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import evaluate
+from scaling import MinMaxScaling
+from selection import GramStatistics
+
+def make_model(spec):
+    '''
+    This function takes in a model spec, a dict with a 'model' name and optional
+    'params', and returns an unfitted sklearn model:
+
+        - 'ols':        LinearRegression
+        - 'lasso_lars': LassoLars
+        - 'tweedie':    TweedieRegressor
+        - 'polynomial': PolynomialFeatures(degree) followed by LinearRegression
+    '''
+    from sklearn.linear_model import LinearRegression, LassoLars, TweedieRegressor
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import PolynomialFeatures
+
+    params = dict(spec.get('params', {}))
+    model = spec['model']
+    if model == 'ols':
+        return LinearRegression(**params)
+    if model == 'lasso_lars':
+        return LassoLars(**params)
+    if model == 'tweedie':
+        return TweedieRegressor(**params)
+    if model == 'polynomial':
+        degree = params.pop('degree', 2)
+        return make_pipeline(PolynomialFeatures(degree), LinearRegression(**params))
+    raise ValueError(f'Unknown model: {model}')
+
+def model_grid(grid):
+    '''
+    This function takes in a dict of {model name: {param: [values]}} and returns a
+    list of model specs, one for every combination of parameter values.
+    '''
+    specs = []
+    for model, params in grid.items():
+        names = list(params)
+        for values in itertools.product(*(params[name] for name in names)):
+            spec_params = dict(zip(names, values))
+            label = ', '.join(f'{name}={value}' for name, value in spec_params.items())
+            specs.append({'name': f'{model}({label})', 'model': model, 'params': spec_params})
+    return specs
+
+# The notebook's models: OLS, LassoLars, a Tweedie GLM and a polynomial OLS
+DEFAULT_GRID = {
+    'ols': {},
+    'lasso_lars': {'alpha': [1.0]},
+    'tweedie': {'power': [1], 'alpha': [0]},
+    'polynomial': {'degree': [2]},
+}
+
+
+class SharedArrays:
+    '''
+    Places a dict of numpy arrays in shared memory once, so worker processes can
+    attach to them by name instead of receiving a pickled copy with every task.
+    Use as a context manager; the shared memory is released on exit.
+    '''
+    def __init__(self, arrays):
+        self.blocks = {}
+        self.meta = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.blocks[name] = block
+            self.meta[name] = (block.name, array.shape, array.dtype.str)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+
+    @staticmethod
+    def attach(meta):
+        '''
+        This method attaches to arrays placed in shared memory by another process
+        and returns the open blocks and a dict of read only array views.
+        '''
+        blocks, arrays = [], {}
+        for name, (block_name, shape, dtype) in meta.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+            array.flags.writeable = False
+            blocks.append(block)
+            arrays[name] = array
+        return blocks, arrays
+
+
+# Arrays attached by each worker process
+_worker_blocks = None
+_worker_arrays = None
+
+def _init_worker(meta):
+    global _worker_blocks, _worker_arrays
+    _worker_blocks, _worker_arrays = SharedArrays.attach(meta)
+
+def fit_spec(spec, arrays=None):
+    '''
+    This function fits the model for one spec on X_train / y_train, scores it on the
+    train and validate sets with evaluate.regression_metrics and returns a dict with
+    the spec, the metrics and the fitted model.
+    '''
+    arrays = _worker_arrays if arrays is None else arrays
+    model = make_model(spec).fit(arrays['X_train'], arrays['y_train'])
+
+    result = {'name': spec.get('name', spec['model']), 'model': spec['model'], 'params': spec.get('params', {})}
+    for split in ['train', 'validate']:
+        metrics = evaluate.regression_metrics(arrays[f'y_{split}'], model.predict(arrays[f'X_{split}']))
+        result.update({f'{split}_{name}': metrics[name] for name in ['rmse', 'r2', 'mae']})
+    result['fitted'] = model
+    return result
+
+def fit_grid(X_train, y_train, X_validate, y_validate, specs=None, n_jobs=None, metric='validate_rmse'):
+    '''
+    This function fits every model spec in specs (DEFAULT_GRID if None) across a
+    process pool of n_jobs workers (all cores if None). The training and validate
+    data are placed in shared memory once, so every worker reads the same copy.
+
+    It returns a dataframe of the metrics of every fit, sorted by metric (lower is
+    better), and the fitted model with the best metric.
+    '''
+    if specs is None:
+        specs = model_grid(DEFAULT_GRID)
+    arrays = {
+        'X_train': np.asarray(X_train, dtype=np.float64),
+        'y_train': np.asarray(y_train, dtype=np.float64).ravel(),
+        'X_validate': np.asarray(X_validate, dtype=np.float64),
+        'y_validate': np.asarray(y_validate, dtype=np.float64).ravel(),
+    }
+    n_jobs = n_jobs or os.cpu_count()
+
+    if n_jobs == 1:
+        results = [fit_spec(spec, arrays) for spec in specs]
+    else:
+        with SharedArrays(arrays) as shared:
+            del arrays
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                     initargs=(shared.meta,)) as executor:
+                results = list(executor.map(fit_spec, specs))
+
+    table = pd.DataFrame(results).sort_values(metric, kind='mergesort', ignore_index=True)
+    best = table.loc[0, 'fitted']
+    return table.drop(columns=['fitted']), best
+
+
+class StreamingRegressor:
+    '''
+    A linear model trained one chunk at a time, so memory stays proportional to the
+    chunk size no matter how much history is streamed through it.
+
+        - method='ols' accumulates the normal equations (selection.GramStatistics)
+          and gives exactly the same coefficients as fitting on all rows at once
+        - method='sgd' updates an sklearn SGDRegressor with partial_fit
+
+    Each chunk is scaled with a fitted scaling.MinMaxScaling (or the path of one
+    saved with its save method) before it is applied. The state can be
+    checkpointed to a .npz file and restored with load_checkpoint.
+    '''
+    def __init__(self, features, target='taxvaluedollarcnt', method='ols', scaler=None, **sgd_params):
+        if method not in ('ols', 'sgd'):
+            raise ValueError(f'Unknown method: {method}')
+        self.features = list(features)
+        self.target = target
+        self.method = method
+        self.scaler = MinMaxScaling.load(scaler) if isinstance(scaler, (str, os.PathLike)) else scaler
+        self.rows_seen = 0
+        self.chunks_seen = 0
+        if method == 'ols':
+            self.model = GramStatistics(columns=self.features)
+        else:
+            from sklearn.linear_model import SGDRegressor
+            self.model = SGDRegressor(**sgd_params)
+
+    def _X(self, df):
+        if self.scaler is None:
+            return df[self.features].to_numpy(dtype=np.float64)
+        return self.scaler.transform(df[self.features])
+
+    def partial_fit(self, df):
+        '''
+        This method scales one chunk and applies it to the model.
+        '''
+        if len(df) == 0:
+            return self
+        X, y = self._X(df), df[self.target].to_numpy(dtype=np.float64)
+        self.model.partial_fit(X, y)
+        self.rows_seen += len(df)
+        self.chunks_seen += 1
+        return self
+
+    @property
+    def intercept_(self):
+        if self.method == 'ols':
+            return self.model.coefficients()[0]
+        return float(self.model.intercept_[0])
+
+    @property
+    def coef_(self):
+        if self.method == 'ols':
+            return self.model.coefficients()[1]
+        return self.model.coef_
+
+    def predict(self, df):
+        '''
+        This method returns the predictions for a dataframe with the feature columns.
+        '''
+        return self._X(df) @ self.coef_ + self.intercept_
+
+    def save_checkpoint(self, path):
+        '''
+        This method saves the coefficients and the state needed to resume training.
+        '''
+        state = {'intercept': self.intercept_, 'coef': self.coef_,
+                 'rows_seen': self.rows_seen, 'chunks_seen': self.chunks_seen}
+        if self.method == 'ols':
+            state.update({'n': self.model.n, 'mean_x': self.model.mean_x, 'mean_y': self.model.mean_y,
+                          'xx': self.model.xx, 'xy': self.model.xy, 'yy': self.model.yy})
+        else:
+            state.update({'t': self.model.t_, 'n_iter': self.model.n_iter_})
+        np.savez(path, **state)
+
+    def load_checkpoint(self, path):
+        '''
+        This method restores the state saved by save_checkpoint.
+        '''
+        with np.load(path) as state:
+            self.rows_seen = int(state['rows_seen'])
+            self.chunks_seen = int(state['chunks_seen'])
+            if self.method == 'ols':
+                self.model.n = int(state['n'])
+                self.model.mean_x, self.model.mean_y = state['mean_x'], float(state['mean_y'])
+                self.model.xx, self.model.xy, self.model.yy = state['xx'], state['xy'], float(state['yy'])
+            else:
+                # A single tiny partial_fit sets up the estimator before its state is replaced
+                self.model.partial_fit(np.zeros((1, len(self.features))), np.zeros(1))
+                self.model.coef_ = state['coef'].copy()
+                self.model.intercept_ = np.array([float(state['intercept'])])
+                self.model.t_, self.model.n_iter_ = float(state['t']), int(state['n_iter'])
+        return self
+
+def fit_streaming(chunks, regressor, prepare=None, checkpoint_path=None, checkpoint_every=10):
+    '''
+    This function trains a StreamingRegressor on an iterable of raw chunks, e.g.
+    acquire.new_zillow_data(chunksize=...). Each chunk is passed through prepare
+    (e.g. pipeline.clean_zillow_pipeline().run) as it arrives and applied to the
+    model, so only one chunk is held in memory at a time.
+
+    If checkpoint_path is given the model is checkpointed every checkpoint_every
+    non-empty chunks and after the last one. Empty chunks are skipped. It returns
+    the regressor.
+    '''
+    for chunk in chunks:
+        if prepare is not None:
+            chunk = prepare(chunk)
+        # A chunk prepare emptied adds nothing, so it neither counts nor checkpoints
+        if len(chunk) == 0:
+            continue
+        regressor.partial_fit(chunk)
+        if checkpoint_path is not None and regressor.chunks_seen % checkpoint_every == 0:
+            regressor.save_checkpoint(checkpoint_path)
+
+    if checkpoint_path is not None and regressor.chunks_seen:
+        regressor.save_checkpoint(checkpoint_path)
+    return regressor
+
+
+# Cleaning steps stored in inference artifacts, in a form score.py can apply with
+# numpy alone: the fills and ratios of prepare.clean_zillow and the coordinate formatting
+ARTIFACT_FILLS = {
+    'calculatedbathnbr': ['bathroomcnt'],
+    'structuretaxvaluedollarcnt': ['taxvaluedollarcnt', 'landtaxvaluedollarcnt'],
+}
+ARTIFACT_COORDINATES = {'latitude': 2, 'longitude': 4}
+ARTIFACT_RATIOS = {
+    'tax_rate': ['taxamount', 'taxvaluedollarcnt'],
+    'bath_per_sqft': ['bathroomcnt', 'calculatedfinishedsquarefeet'],
+}
+
+def build_artifact(path, model, features, scaler=None):
+    '''
+    This function saves everything needed to score raw parcels into one .npz file
+    that score.load_artifact reads with numpy alone:
+
+        - the cleaning steps (fills, coordinate formatting and ratio features)
+        - the fitted scaling parameters
+        - the selected feature list
+        - the model coefficients, intercept and link function
+
+    model can be a fitted LinearRegression, LassoLars, TweedieRegressor or
+    StreamingRegressor (whose scaler is used if scaler is None).
+    '''
+    if isinstance(model, StreamingRegressor):
+        scaler = model.scaler if scaler is None else scaler
+        coef, intercept, link = model.coef_, model.intercept_, 'identity'
+    elif hasattr(model, 'coef_') and hasattr(model, 'intercept_'):
+        coef, intercept = model.coef_, model.intercept_
+        link = 'identity'
+        if hasattr(model, 'power'):
+            link = model.link if model.link != 'auto' else ('log' if model.power > 0 else 'identity')
+    else:
+        raise ValueError(f'{type(model).__name__} has no linear coefficients to export')
+
+    features = list(features)
+    if scaler is None:
+        scale, offset = np.ones(len(features)), np.zeros(len(features))
+    else:
+        positions = [scaler.columns.index(col) for col in features]
+        scale, offset = scaler.scale_[positions], scaler.min_[positions]
+
+    columns = []
+    for col in features:
+        sources = ARTIFACT_RATIOS.get(col, [col] + ARTIFACT_FILLS.get(col, []))
+        columns += [source for source in sources if source not in columns]
+
+    meta = {
+        'features': features,
+        'columns': columns,
+        'fills': ARTIFACT_FILLS,
+        'coordinates': ARTIFACT_COORDINATES,
+        'ratios': ARTIFACT_RATIOS,
+        'link': link,
+    }
+    np.savez(path, coef=np.asarray(coef, dtype=np.float64).ravel(), intercept=float(np.ravel(intercept)[0]),
+             scale=np.asarray(scale, dtype=np.float64), min=np.asarray(offset, dtype=np.float64),
+             meta=json.dumps(meta))
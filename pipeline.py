@@ -0,0 +1,200 @@
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from prepare import COUNTY_BY_FIPS, normalize_coordinates
+
+class ZillowPipeline:
+    '''
+    A declarative version of the clean_zillow / prepare_zillow steps that plans
+    the work before touching the data and runs it with as few copies as possible:
+
+        - fills, the dropna and every outlier filter are folded into one row mask,
+          and each kept column is copied exactly once when the mask is applied
+        - fills and derived columns that are dropped at the end are not computed
+          (a dropped fill still counts towards the dropna mask)
+        - coordinates and derived columns are only computed for the rows that are kept
+
+    The input dataframe is never modified. Arguments:
+
+        fills:       {col: (func, [source cols])} fill missing values of col with func(cols)
+        coordinates: {col: int_digits} format coordinates with normalize_coordinates
+        derived:     {col: (func, [source cols])} new columns computed from func(cols)
+        astype:      {col: dtype} dtypes for the output columns
+        drop:        columns to leave out of the output
+        outliers:    [(col, k, lower)] drop rows at or above q3 + k * iqr of col
+                     (and at or below q1 - k * iqr if lower is True), applied in order
+        dropna:      drop rows with a missing value in any input column
+
+    func always gets a dict of column name -> numpy array.
+    '''
+    def __init__(self, index='parcelid', fills=None, coordinates=None, derived=None,
+                 astype=None, drop=None, outliers=None, dropna=True):
+        self.index = index
+        self.fills = dict(fills or {})
+        self.coordinates = dict(coordinates or {})
+        self.derived = dict(derived or {})
+        self.astype = dict(astype or {})
+        self.drop = list(drop or [])
+        self.outliers = list(outliers or [])
+        self.dropna = dropna
+        self.report_ = None
+
+    def plan(self, columns):
+        '''
+        This method takes in the input column names and returns a dict describing
+        the work the pipeline will do: which columns are kept, which fills and
+        derived columns are computed, and which are skipped because they are dropped.
+        '''
+        inputs = [col for col in columns if col != self.index]
+        derived = [col for col in self.derived if col not in self.drop]
+        for col, _, _ in self.outliers:
+            if col not in inputs:
+                raise ValueError(f'Outlier filters only work on input columns, not {col}')
+
+        kept = [col for col in inputs if col not in self.drop]
+        # Columns that have to be sliced because a kept column is computed from them
+        needed = set(kept)
+        needed.update(src for col in derived for src in self.derived[col][1])
+        needed.update(src for col in self.fills if col in needed for src in self.fills[col][1])
+
+        return {
+            'kept': kept + derived,
+            'sliced': [col for col in inputs if col in needed],
+            'fills': [col for col in self.fills if col in needed],
+            'mask_only_fills': [col for col in self.fills if col not in needed],
+            'coordinates': [col for col in self.coordinates if col in kept],
+            'derived': derived,
+            'skipped': [col for col in self.derived if col in self.drop],
+        }
+
+    def run(self, df, report=False):
+        '''
+        This method takes in a zillow dataframe and returns the prepared dataframe.
+        The input is never modified.
+
+        If report is True, the wall time and peak traced memory of every stage is
+        stored as a dataframe in the report_ attribute.
+        '''
+        plan = self.plan(df.columns)
+        stages = []
+        tracing = report and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+
+        def stage(name, func):
+            if report:
+                tracemalloc.reset_peak()
+                start_memory = tracemalloc.get_traced_memory()[0]
+                start = time.perf_counter()
+            result = func()
+            if report:
+                seconds = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1] - start_memory
+                stages.append({'stage': name, 'seconds': seconds, 'peak_bytes': peak})
+            return result
+
+        try:
+            # Read only views of the input columns
+            columns = stage('select', lambda: {col: df[col].to_numpy() for col in df.columns})
+            mask = stage('mask', lambda: self._row_mask(columns, plan))
+            mask = stage('outliers', lambda: self._outlier_mask(columns, mask))
+            out = stage('take', lambda: {col: columns[col][mask] for col in plan['sliced']})
+            stage('fill', lambda: self._fill(out, plan))
+            stage('coordinates', lambda: self._format_coordinates(out, plan))
+            stage('derive', lambda: self._derive(out, plan))
+            result = stage('frame', lambda: self._frame(out, plan, columns[self.index][mask], df.dtypes))
+        finally:
+            if tracing:
+                tracemalloc.stop()
+
+        if report:
+            self.report_ = pd.DataFrame(stages).set_index('stage')
+        return result
+
+    def _row_mask(self, columns, plan):
+        mask = np.ones(len(columns[self.index]), dtype=bool)
+        if not self.dropna:
+            return mask
+        for col in columns:
+            if col == self.index:
+                continue
+            valid = pd.notna(columns[col])
+            if col in self.fills:
+                func, sources = self.fills[col]
+                valid |= pd.notna(func({src: columns[src] for src in sources}))
+            mask &= valid
+        return mask
+
+    def _outlier_mask(self, columns, mask):
+        for col, k, lower in self.outliers:
+            q1, q3 = np.quantile(columns[col][mask], [.25, .75])
+            iqr = q3 - q1
+            mask &= columns[col] < q3 + k * iqr
+            if lower:
+                mask &= columns[col] > q1 - k * iqr
+        return mask
+
+    def _fill(self, out, plan):
+        for col in plan['fills']:
+            func, sources = self.fills[col]
+            out[col] = np.where(pd.isna(out[col]), func({src: out[src] for src in sources}), out[col])
+
+    def _format_coordinates(self, out, plan):
+        for col in plan['coordinates']:
+            out[col] = normalize_coordinates(out[col], self.coordinates[col])
+
+    def _derive(self, out, plan):
+        for col in plan['derived']:
+            func, sources = self.derived[col]
+            out[col] = func({src: out[src] for src in sources})
+
+    def _frame(self, out, plan, index, dtypes):
+        index = pd.Index(index, name=self.index)
+        data = {}
+        for col in plan['kept']:
+            # Input columns keep their dtype unless astype says otherwise
+            dtype = self.astype.get(col, dtypes.get(col))
+            data[col] = pd.Series(out[col], index=index, dtype=dtype, copy=False)
+        return pd.DataFrame(data, index=index, copy=False)
+
+
+# Steps shared by the clean and prepare pipelines
+ZILLOW_FILLS = {
+    'calculatedbathnbr': (lambda c: c['bathroomcnt'], ['bathroomcnt']),
+    'structuretaxvaluedollarcnt': (lambda c: c['taxvaluedollarcnt'] - c['landtaxvaluedollarcnt'],
+                                   ['taxvaluedollarcnt', 'landtaxvaluedollarcnt']),
+}
+
+ZILLOW_DERIVED = {
+    'county': (lambda c: pd.Series(c['fips']).map(COUNTY_BY_FIPS).to_numpy(), ['fips']),
+    'tax_rate': (lambda c: c['taxamount'] / c['taxvaluedollarcnt'], ['taxamount', 'taxvaluedollarcnt']),
+    'bath_per_sqft': (lambda c: c['bathroomcnt'] / c['calculatedfinishedsquarefeet'],
+                      ['bathroomcnt', 'calculatedfinishedsquarefeet']),
+}
+
+def clean_zillow_pipeline():
+    '''
+    This function returns a ZillowPipeline that does the same as prepare.clean_zillow.
+    '''
+    return ZillowPipeline(fills=ZILLOW_FILLS,
+                          coordinates={'latitude': 2, 'longitude': 4},
+                          derived=ZILLOW_DERIVED,
+                          astype={'fips': 'int64'})
+
+def prepare_zillow_pipeline():
+    '''
+    This function returns a ZillowPipeline that does the same as prepare.prepare_zillow.
+    Only the four kept columns are copied; county, tax_rate, bath_per_sqft and
+    the coordinates are never computed.
+    '''
+    cols_to_drop = ['propertylandusetypeid', 'propertylandusedesc','landtaxvaluedollarcnt','taxamount',
+                'structuretaxvaluedollarcnt', 'longitude', 'latitude', 'fips', 'calculatedbathnbr', 'county', 'tax_rate',
+                'bath_per_sqft']
+    return ZillowPipeline(fills=ZILLOW_FILLS,
+                          coordinates={'latitude': 2, 'longitude': 4},
+                          derived=ZILLOW_DERIVED,
+                          astype={'fips': 'int64'},
+                          drop=cols_to_drop,
+                          outliers=[('taxvaluedollarcnt', 3, False)])
@@ -1,49 +1,50 @@
 import numpy as np
 import pandas as pd
 import os
-from sklearn.model_selection import train_test_split
-import sklearn.preprocessing
-from env import host, user, password
+from scaling import MinMaxScaling
+from coordinates import normalize_coordinates
+from instrument import instrumented
 
 # Establish a connection
-def get_connection(db, user=user, host=host, password=password):
+def get_connection(db, user=None, host=None, password=None):
     '''
     This function uses my info from my env file to
     create a connection url to access the CodeUp db.
+    The env file is only read here, when a credential is not passed in.
     '''
+    if None in (user, host, password):
+        import env
+        user = env.user if user is None else user
+        host = env.host if host is None else host
+        password = env.password if password is None else password
     return f'mysql+pymysql://{user}:{password}@{host}/{db}'
 
 def get_latitude(df):
     '''
     This function takes in a datafame with latitude formatted as a float,
-    converts it to a int and utilizes lambda to return the latitude values
+    truncates it to an integer and returns the latitude values
     in a correct format.
     '''
-    df.latitude = df.latitude.astype(int)
-    df['latitude'] = df['latitude'].apply(lambda x: x / 10 ** (len((str(x))) - 2))
+    df['latitude'] = normalize_coordinates(df['latitude'].to_numpy(), 2)
     return df
 
 def get_longitude(df):
     '''This function takes in a datafame with longitude formatted as a float,
-    converts it to a int and utilizes lambda to return the longitude values
+    truncates it to an integer and returns the longitude values
     in the correct format.
     '''
-    df.longitude = df.longitude.astype(int)
-    df['longitude'] = df['longitude'].apply(lambda x: x / 10 ** (len((str(x))) - 4))
+    df['longitude'] = normalize_coordinates(df['longitude'].to_numpy(), 4)
     return df
 
+COUNTY_BY_FIPS = {6037: 'Los Angeles', 6059: 'Orange', 6111: 'Ventura'}
+
 def get_county(df):
-    county = []
-
-    for row in df['fips']:
-        if row == 6037:
-            county.append('Los Angeles')
-        elif row == 6059:
-            county.append('Orange')
-        elif row == 6111:
-            county.append('Ventura')
-        
-    df['county'] = county
+    '''
+    This function takes in a dataframe with a fips column and adds a county
+    column with the county name for each fips code. Rows with a fips code that
+    is not in COUNTY_BY_FIPS get a missing county.
+    '''
+    df['county'] = df['fips'].map(COUNTY_BY_FIPS)
     return df
 
 def calculate_tax_rate(df):
@@ -92,7 +93,68 @@ def remove_square_feet_outliers(df):
     
     return df
 
-def clean_zillow(df):
+# Columns compact_zillow stores as categories and as small integers
+CATEGORICAL_COLS = ['county', 'propertylandusetypeid', 'propertylandusedesc']
+INTEGER_COLS = ['bedroomcnt', 'fips']
+
+def compact_zillow(df, rtol=None):
+    '''
+    This function takes in a zillow dataframe and returns a copy that uses less memory:
+
+        - county, propertylandusetypeid and propertylandusedesc become categories
+        - bedroomcnt and fips (and any integer column) become the smallest
+          integer type that fits
+        - other float64 columns become float32 if that loses no precision, or if
+          rtol is given, if the relative error stays within rtol
+
+    Use memory_report to compare the bytes per column before and after.
+    '''
+    compact = {}
+    for col in df.columns:
+        values = df[col]
+        if col == 'county':
+            values = values.astype(pd.CategoricalDtype(list(COUNTY_BY_FIPS.values())))
+        elif col in CATEGORICAL_COLS or values.dtype == 'object':
+            values = values.astype('category')
+        elif col in INTEGER_COLS and values.notna().all() and (values % 1 == 0).all():
+            values = pd.to_numeric(values.astype('int64'), downcast='integer')
+        elif pd.api.types.is_integer_dtype(values):
+            values = pd.to_numeric(values, downcast='integer')
+        elif values.dtype == 'float64':
+            as_float32 = values.astype('float32')
+            if rtol is None:
+                fits = (as_float32.astype('float64') == values)[values.notna()].all()
+            else:
+                fits = np.allclose(as_float32, values, rtol=rtol, atol=0, equal_nan=True)
+            if fits:
+                values = as_float32
+        compact[col] = values
+
+    index = df.index
+    if pd.api.types.is_integer_dtype(index):
+        index = pd.Index(pd.to_numeric(index, downcast='integer'), name=index.name)
+    return pd.DataFrame(compact, index=index)
+
+def memory_report(before, after):
+    '''
+    This function takes in a dataframe before and after compact_zillow and returns
+    a dataframe with the dtype and bytes of each column (and the index) in both,
+    plus a total row.
+    '''
+    report = pd.DataFrame({
+        'dtype_before': before.dtypes.astype(str),
+        'dtype_after': after.dtypes.astype(str),
+        'bytes_before': before.memory_usage(deep=True, index=False),
+        'bytes_after': after.memory_usage(deep=True, index=False),
+    })
+    report.loc['Index'] = [str(before.index.dtype), str(after.index.dtype),
+                           before.index.memory_usage(deep=True), after.index.memory_usage(deep=True)]
+    report.loc['Total'] = ['', '', report.bytes_before.sum(), report.bytes_after.sum()]
+    report['pct_saved'] = round((1 - report.bytes_after / report.bytes_before) * 100, 2)
+    return report
+
+@instrumented()
+def clean_zillow(df, compact=False):
     '''
     This function reads in the zillow dataframe with 15 columns and 24950 rows
     from my acquire module and cleans it by: 
@@ -105,6 +167,7 @@ def clean_zillow(df):
         -Droping remaining observations with missing values.
 
     It returns a dataframe with 14 columns and 24947 rows.
+    If compact is True the result is passed through compact_zillow.
     '''
     # Set parcelid as the index
     df = df.set_index('parcelid')
@@ -113,7 +176,7 @@ def clean_zillow(df):
     df.calculatedbathnbr = df.calculatedbathnbr.fillna(df.bathroomcnt)
     
     #Replace missing values in structuretaxvaluedollarcount = taxvaluedollarcnt - landtaxvaluedollarcnt
-    df.structuretaxvaluedollarcnt.fillna((df.taxvaluedollarcnt - df.landtaxvaluedollarcnt), inplace=True)
+    df.structuretaxvaluedollarcnt = df.structuretaxvaluedollarcnt.fillna(df.taxvaluedollarcnt - df.landtaxvaluedollarcnt)
     
     #Call get_latitude fucntion to clean latitude
     get_latitude(df)
@@ -135,9 +198,13 @@ def clean_zillow(df):
 
     #Call bathrooms_per_squarefeet function to calculate the rate of ba per sqft
     df = bathrooms_per_squareft(df)
+
+    if compact:
+        df = compact_zillow(df)
     
     return df
 
+@instrumented()
 def prepare_zillow(df):
     '''
     This function  loads in a zillow  dataframe, utilizes the
@@ -164,13 +231,13 @@ def split_stratify_continuous(df, target, bins=5):
     This function splits a data frame into train, test, validate
     and startifies by a continuous target variable.
     '''
+    from sklearn.model_selection import train_test_split
+
+    # Stratify on the binned target without adding a column to the caller's df
     binned_y = pd.cut(df[target], bins=bins, labels=list(range(bins)))
-    df["bins"] = binned_y
-    train_validate, test = train_test_split(df, stratify=df["bins"], test_size=0.2, random_state=123)
-    train, validate = train_test_split(train_validate, stratify=train_validate["bins"], test_size=0.3, random_state=123)
-    train = train.drop(columns=["bins"])
-    validate = validate.drop(columns=["bins"])
-    test = test.drop(columns=["bins"])
+    train_validate, test, binned_train_validate, _ = train_test_split(df, binned_y, stratify=binned_y,
+                                                                      test_size=0.2, random_state=123)
+    train, validate = train_test_split(train_validate, stratify=binned_train_validate, test_size=0.3, random_state=123)
     return train, test, validate
 
 def prepare_zillow_2nd(df):
@@ -187,7 +254,8 @@ def prepare_zillow_2nd(df):
     
     #cols_to_keep = ['propertylandusedesc', 'longitude', 'latitude', 'county']
 
-    df.drop(columns=cols_to_drop, inplace=True)
+    # Drop into a new frame so the caller's dataframe is left alone
+    df = df.drop(columns=cols_to_drop)
 
     #Drop tax value outliers using IQR
     df = remove_tax_value_outliers(df) 
@@ -263,39 +331,26 @@ def get_numeric_X_cols(X_train, object_cols):
     
     return numeric_cols
 
-def min_max_scale(X_train, X_validate, X_test, numeric_cols):
+@instrumented()
+def min_max_scale(X_train, X_validate, X_test, numeric_cols, return_scaler=False):
     '''
     this function takes in 3 dataframes with the same columns, 
     a list of numeric column names (because the scaler can only work with numeric columns),
     and fits a min-max scaler to the first dataframe and transforms all
     3 dataframes using that scaler. 
     it returns 3 dataframes with the same column names and scaled values. 
+    If return_scaler is True the fitted MinMaxScaling is returned as well, so it can
+    be saved and reused at inference time.
     '''
     # create the scaler object and fit it to X_train (i.e. identify min and max)
-    # if copy = false, inplace row normalization happens and avoids a copy (if the input is already a numpy array).
-
-
-    scaler = sklearn.preprocessing.MinMaxScaler()
-    scaler.fit(X_train[numeric_cols])
+    scaler = MinMaxScaling(columns=numeric_cols).fit(X_train)
 
     #scale X_train, X_validate, X_test using the mins and maxes stored in the scaler derived from X_train. 
-    # 
-    X_train_scaled_array = scaler.transform(X_train[numeric_cols])
-    X_validate_scaled_array = scaler.transform(X_validate[numeric_cols])
-    X_test_scaled_array = scaler.transform(X_test[numeric_cols])
-
-    # convert arrays to dataframes
-    X_train_scaled = pd.DataFrame(X_train_scaled_array, 
-                                  columns=numeric_cols).\
-                                  set_index([X_train.index.values])
-
-    X_validate_scaled = pd.DataFrame(X_validate_scaled_array, 
-                                     columns=numeric_cols).\
-                                     set_index([X_validate.index.values])
-
-    X_test_scaled = pd.DataFrame(X_test_scaled_array, 
-                                 columns=numeric_cols).\
-                                 set_index([X_test.index.values])
-
-    
-    return X_train_scaled, X_validate_scaled, X_test_scaled
\ No newline at end of file
+    # each result wraps the scaled array with the original index without another copy
+    X_train_scaled = scaler.transform_frame(X_train)
+    X_validate_scaled = scaler.transform_frame(X_validate)
+    X_test_scaled = scaler.transform_frame(X_test)
+
+    if return_scaler:
+        return X_train_scaled, X_validate_scaled, X_test_scaled, scaler
+    return X_train_scaled, X_validate_scaled, X_test_scaled
@@ -1,9 +1,8 @@
 import numpy as np
 import pandas as pd
 import os
-from sklearn.model_selection import train_test_split
-import sklearn.preprocessing
-from env import host, user, password
+from scaling import MinMaxScaling
+from instrument import instrumented
 
 def get_object_cols(df):
     '''
@@ -49,13 +48,13 @@ def train_validate_test(df, target, bins=5):
     The function returns 3 dataframes and 3 series:
     X_train (df) & y_train (series), X_validate & y_validate, X_test & y_test. 
     '''
+    from sklearn.model_selection import train_test_split
+
+    # Stratify on the binned target without adding a column to the caller's df
     binned_y = pd.cut(df[target], bins=bins, labels=list(range(bins)))
-    df["bins"] = binned_y
-    train_validate, test = train_test_split(df, stratify=df["bins"], test_size=0.2, random_state=123)
-    train, validate = train_test_split(train_validate, stratify=train_validate["bins"], test_size=0.3, random_state=123)
-    train = train.drop(columns=["bins"])
-    validate = validate.drop(columns=["bins"])
-    test = test.drop(columns=["bins"])
+    train_validate, test, binned_train_validate, _ = train_test_split(df, binned_y, stratify=binned_y,
+                                                                      test_size=0.2, random_state=123)
+    train, validate = train_test_split(train_validate, stratify=binned_train_validate, test_size=0.3, random_state=123)
 
     # split train into X (dataframe, drop target) & y (series, keep target only)
     X_train = train.drop(columns=[target])
@@ -71,6 +70,87 @@ def train_validate_test(df, target, bins=5):
     
     return X_train, y_train, X_validate, y_validate, X_test, y_test
 
+# Split labels used by split_indices and hash_split
+TRAIN, VALIDATE, TEST = 0, 1, 2
+
+def split_labels(y, bins=5, test_size=0.2, validate_size=0.3, random_state=123):
+    '''
+    This function takes in the target and returns an array labelling each row
+    TRAIN, VALIDATE or TEST, stratified by the target cut into bins equal width bins.
+    test_size is the share of all rows and validate_size the share of the rest, so the
+    defaults give the same 56/24/20 split as train_validate_test.
+
+    It makes one pass: rows are shuffled within each bin and the shares are cut
+    from each bin in order. Nothing is added to the caller's data. A missing
+    target cannot be stratified, so it raises a ValueError.
+    '''
+    y = np.asarray(y, dtype=np.float64)
+    if np.isnan(y).any():
+        raise ValueError(f'y has {int(np.isnan(y).sum())} missing values; drop or fill them before splitting')
+    binned_y = pd.cut(y, bins=bins, labels=False)
+    rng = np.random.default_rng(random_state)
+
+    # Group rows by bin, in random order within each bin
+    order = np.lexsort((rng.random(len(y)), binned_y))
+    counts = np.bincount(binned_y, minlength=bins)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    position = (np.arange(len(y)) - starts + 0.5) / np.repeat(counts, counts)
+
+    labels = np.empty(len(y), dtype=np.int8)
+    labels[order] = np.where(position < test_size, TEST,
+                             np.where(position < test_size + (1 - test_size) * validate_size, VALIDATE, TRAIN))
+    return labels
+
+def split_indices(y, bins=5, test_size=0.2, validate_size=0.3, random_state=123):
+    '''
+    This function returns the integer positions of the train, validate and test rows
+    (see split_labels). Use them with .iloc or on numpy arrays.
+    '''
+    labels = split_labels(y, bins, test_size, validate_size, random_state)
+    return tuple(np.flatnonzero(labels == label) for label in (TRAIN, VALIDATE, TEST))
+
+def _splitmix64(x):
+    '''
+    The splitmix64 finalizer applied element-wise to a uint64 array.
+    '''
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+def hash_split(parcelid, y, bin_edges, test_size=0.2, validate_size=0.3, salt=123):
+    '''
+    This function labels each row TRAIN, VALIDATE or TEST from a stable hash of its
+    parcelid combined with the bin of its target. bin_edges are fixed target bin edges
+    (e.g. from an earlier extract) so that the label of a row only depends on the row.
+
+    Splits are reproducible across streamed chunks and incremental runs without
+    holding the whole dataset, and new rows never move an existing parcel to a
+    different split.
+    '''
+    parcelid = np.asarray(parcelid).astype(np.uint64)
+    binned_y = np.digitize(np.asarray(y), np.asarray(bin_edges)[1:-1]).astype(np.uint64)
+
+    with np.errstate(over='ignore'):
+        key = parcelid ^ _splitmix64(binned_y * np.uint64(0x9E3779B97F4A7C15) + np.uint64(salt))
+    # Top 53 bits of the hash as a uniform number in [0, 1)
+    u = (_splitmix64(key) >> np.uint64(11)) * 2.0 ** -53
+
+    return np.where(u < test_size, TEST,
+                    np.where(u < test_size + (1 - test_size) * validate_size, VALIDATE, TRAIN)).astype(np.int8)
+
+def split_views(values, labels):
+    '''
+    This function takes in a numpy array and split labels and returns the train,
+    validate and test rows as views into a single reordered copy of the array,
+    so the partitions share one allocation instead of three.
+    '''
+    order = np.argsort(labels, kind='stable')
+    grouped = np.asarray(values)[order]
+    bounds = np.cumsum(np.bincount(labels, minlength=3))
+    return grouped[:bounds[0]], grouped[bounds[0]:bounds[1]], grouped[bounds[1]:]
+
 def get_numeric_X_cols(X_train, object_cols):
     '''
     takes in a dataframe and list of object column names
@@ -80,38 +160,26 @@ def get_numeric_X_cols(X_train, object_cols):
     
     return numeric_cols
 
-def min_max_scale(X_train, X_validate, X_test, numeric_cols):
+@instrumented()
+def min_max_scale(X_train, X_validate, X_test, numeric_cols, return_scaler=False):
     '''
     this function takes in 3 dataframes with the same columns, 
     a list of numeric column names (because the scaler can only work with numeric columns),
     and fits a min-max scaler to the first dataframe and transforms all
     3 dataframes using that scaler. 
     it returns 3 dataframes with the same column names and scaled values. 
+    If return_scaler is True the fitted MinMaxScaling is returned as well, so it can
+    be saved and reused at inference time.
     '''
     # create the scaler object and fit it to X_train (i.e. identify min and max)
-    # if copy = false, inplace row normalization happens and avoids a copy (if the input is already a numpy array).
-
-    scaler = sklearn.preprocessing.MinMaxScaler()
-    scaler.fit(X_train[numeric_cols])
+    scaler = MinMaxScaling(columns=numeric_cols).fit(X_train)
 
     #scale X_train, X_validate, X_test using the mins and maxes stored in the scaler derived from X_train. 
-    # 
-    X_train_scaled_array = scaler.transform(X_train[numeric_cols])
-    X_validate_scaled_array = scaler.transform(X_validate[numeric_cols])
-    X_test_scaled_array = scaler.transform(X_test[numeric_cols])
-
-    # convert arrays to dataframes
-    X_train_scaled = pd.DataFrame(X_train_scaled_array, 
-                                  columns=numeric_cols).\
-                                  set_index([X_train.index.values])
+    # each result wraps the scaled array with the original index without another copy
+    X_train_scaled = scaler.transform_frame(X_train)
+    X_validate_scaled = scaler.transform_frame(X_validate)
+    X_test_scaled = scaler.transform_frame(X_test)
 
-    X_validate_scaled = pd.DataFrame(X_validate_scaled_array, 
-                                     columns=numeric_cols).\
-                                     set_index([X_validate.index.values])
-
-    X_test_scaled = pd.DataFrame(X_test_scaled_array, 
-                                 columns=numeric_cols).\
-                                 set_index([X_test.index.values])
-
-    
-    return X_train_scaled, X_validate_scaled, X_test_scaled
\ No newline at end of file
+    if return_scaler:
+        return X_train_scaled, X_validate_scaled, X_test_scaled, scaler
+    return X_train_scaled, X_validate_scaled, X_test_scaled
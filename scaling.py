@@ -0,0 +1,137 @@
+import json
+import numpy as np
+import pandas as pd
+
+class MinMaxScaling:
+    '''
+    A min-max scaler that is fit once and reused for training, batch scoring and
+    online scoring. It gives the same values as sklearn's MinMaxScaler but:
+
+        - it can be fit chunk by chunk (partial_fit) and fits from different
+          chunks or workers can be merged, since only the mins and maxes are kept
+        - it transforms in place, into preallocated (e.g. float32) buffers,
+          or chunk by chunk
+        - its parameters are saved to a small .npz file and loaded back with load
+    '''
+    def __init__(self, feature_range=(0, 1), columns=None):
+        self.feature_range = tuple(feature_range)
+        self.columns = None if columns is None else list(columns)
+        self.data_min_ = None
+        self.data_max_ = None
+        self.n_samples_seen_ = 0
+
+    def _values(self, X, dtype=None):
+        if isinstance(X, pd.DataFrame):
+            if self.columns is None:
+                self.columns = X.columns.tolist()
+            X = X[self.columns]
+        return np.asarray(X, dtype=dtype)
+
+    def partial_fit(self, X):
+        '''
+        This method updates the mins and maxes with one chunk of data.
+        '''
+        X = self._values(X, dtype=np.float64)
+        data_min, data_max = np.nanmin(X, axis=0), np.nanmax(X, axis=0)
+        if self.data_min_ is None:
+            self.data_min_, self.data_max_ = data_min, data_max
+        else:
+            self.data_min_ = np.fmin(self.data_min_, data_min)
+            self.data_max_ = np.fmax(self.data_max_, data_max)
+        self.n_samples_seen_ += X.shape[0]
+        return self
+
+    def fit(self, X):
+        '''
+        This method fits the scaler to a dataframe, an array or an iterable of chunks.
+        '''
+        if isinstance(X, (pd.DataFrame, np.ndarray)):
+            X = [X]
+        for chunk in X:
+            self.partial_fit(chunk)
+        return self
+
+    def merge(self, other):
+        '''
+        This method merges the mins and maxes of a scaler fit on other chunks into this one.
+        '''
+        if other.data_min_ is None:
+            return self
+        if self.data_min_ is None:
+            self.data_min_, self.data_max_ = other.data_min_.copy(), other.data_max_.copy()
+            self.columns = other.columns
+        else:
+            self.data_min_ = np.fmin(self.data_min_, other.data_min_)
+            self.data_max_ = np.fmax(self.data_max_, other.data_max_)
+        self.n_samples_seen_ += other.n_samples_seen_
+        return self
+
+    @property
+    def scale_(self):
+        data_range = self.data_max_ - self.data_min_
+        # Constant columns are left unscaled, as in sklearn
+        data_range = np.where(data_range == 0, 1.0, data_range)
+        return (self.feature_range[1] - self.feature_range[0]) / data_range
+
+    @property
+    def min_(self):
+        return self.feature_range[0] - self.data_min_ * self.scale_
+
+    def transform(self, X, out=None, dtype=np.float64):
+        '''
+        This method scales X and returns a numpy array.
+
+        If out is given the result is written into it (it can be X itself to scale
+        a float array in place, or a preallocated float32 buffer). Otherwise a new
+        array of dtype is returned.
+        '''
+        values = self._values(X)
+        if out is None:
+            out = np.array(values, dtype=dtype)
+        elif out is not values:
+            out[...] = values
+        out *= self.scale_.astype(out.dtype, copy=False)
+        out += self.min_.astype(out.dtype, copy=False)
+        return out
+
+    def transform_frame(self, X):
+        '''
+        This method scales a dataframe and returns a dataframe with the same index,
+        built around the scaled array without another copy.
+        '''
+        return pd.DataFrame(self.transform(X), columns=self.columns, index=X.index, copy=False)
+
+    def transform_chunks(self, chunks, dtype=np.float32):
+        '''
+        This method scales an iterable of chunks, reusing one buffer of dtype for
+        chunks of the same size. Each yielded array is overwritten by the next one,
+        so copy it if it has to be kept.
+        '''
+        buffer = None
+        for chunk in chunks:
+            rows = len(chunk)
+            if buffer is None or buffer.shape[0] < rows:
+                buffer = np.empty((rows, len(self.data_min_)), dtype=dtype)
+            yield self.transform(chunk, out=buffer[:rows])
+
+    def save(self, path):
+        '''
+        This method saves the fitted parameters to a .npz file.
+        '''
+        np.savez(path, data_min=self.data_min_, data_max=self.data_max_,
+                 feature_range=np.array(self.feature_range, dtype=np.float64),
+                 n_samples_seen=self.n_samples_seen_,
+                 columns=json.dumps(self.columns))
+
+    @classmethod
+    def load(cls, path):
+        '''
+        This method loads a scaler saved with save.
+        '''
+        with np.load(path) as params:
+            scaler = cls(feature_range=params['feature_range'].tolist(),
+                         columns=json.loads(str(params['columns'])))
+            scaler.data_min_ = params['data_min']
+            scaler.data_max_ = params['data_max']
+            scaler.n_samples_seen_ = int(params['n_samples_seen'])
+        return scaler
@@ -0,0 +1,131 @@
+'''
+Batch scoring from a single inference artifact built with modeling.build_artifact.
+
+This module only imports numpy (pyarrow is imported on first use to read csv or
+parquet files), so it loads fast and can score in a worker without pandas or sklearn:
+
+    python score.py model.npz parcels.csv predictions.csv
+'''
+import json
+import sys
+import numpy as np
+
+from coordinates import normalize_coordinates
+
+# Raw columns every artifact may read; parcelid is passed through to the output
+ID_COLUMN = 'parcelid'
+
+def load_artifact(path):
+    '''
+    This function loads an artifact saved by modeling.build_artifact and returns a
+    dict with its metadata and the model with the scaling folded into the coefficients.
+    '''
+    with np.load(path, allow_pickle=False) as saved:
+        meta = json.loads(str(saved['meta']))
+        coef, intercept = saved['coef'], float(saved['intercept'])
+        scale, offset = saved['scale'], saved['min']
+
+    # (X * scale + offset) @ coef + intercept == X @ weights + bias
+    meta['weights'] = scale * coef
+    meta['bias'] = intercept + offset @ coef
+    return meta
+
+def clean_columns(artifact, columns):
+    '''
+    This function applies the artifact's cleaning steps to a dict of raw float
+    columns and returns the feature matrix (rows x features). Rows that still have
+    a missing value get NaN features.
+    '''
+    columns = {name: np.asarray(values, dtype=np.float64) for name, values in columns.items()}
+    for col, source in artifact['fills'].items():
+        if col in columns:
+            fill = columns[source[0]] if len(source) == 1 else columns[source[0]] - columns[source[1]]
+            columns[col] = np.where(np.isnan(columns[col]), fill, columns[col])
+    for col, int_digits in artifact['coordinates'].items():
+        if col in artifact['features']:
+            columns[col] = normalize_coordinates(columns[col], int_digits)
+    for col, (numerator, denominator) in artifact['ratios'].items():
+        if col in artifact['features']:
+            columns[col] = columns[numerator] / columns[denominator]
+
+    return np.column_stack([columns[col] for col in artifact['features']])
+
+def predict(artifact, X):
+    '''
+    This function scores a cleaned feature matrix (rows x features).
+    '''
+    prediction = X @ artifact['weights'] + artifact['bias']
+    if artifact['link'] == 'log':
+        np.exp(prediction, out=prediction)
+    return prediction
+
+def score_columns(artifact, columns):
+    '''
+    This function cleans and scores a dict of raw columns (or a 2-D array with
+    the artifact's raw columns in order) and returns one prediction per row.
+    '''
+    if not isinstance(columns, dict):
+        columns = np.asarray(columns, dtype=np.float64)
+        columns = {col: columns[:, i] for i, col in enumerate(artifact['columns'])}
+    return predict(artifact, clean_columns(artifact, columns))
+
+def read_batches(path, columns, batch_size=1_000_000, optional=()):
+    '''
+    This function yields dicts of numpy columns of at most batch_size rows from a
+    csv or parquet file (csv columns are read as float64). The optional columns are read only if the file has them;
+    a missing required column raises an error.
+    '''
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(path)
+        names = parquet_file.schema_arrow.names
+    else:
+        import csv
+        import pyarrow.csv as pv
+        with open(path, newline='') as f:
+            names = next(csv.reader(f), [])
+    columns = list(columns) + [col for col in optional if col in names and col not in columns]
+
+    if path.endswith('.parquet'):
+        reader = parquet_file.iter_batches(batch_size=batch_size, columns=columns)
+    else:
+        import pyarrow as pa
+
+        # Every column is read as float64, so a column that is empty or integral in
+        # the first block and has floats later does not fail mid-file
+        options = pv.ReadOptions(block_size=64 << 20)
+        convert = pv.ConvertOptions(include_columns=columns, column_types={col: pa.float64() for col in columns})
+        reader = pv.open_csv(path, read_options=options, convert_options=convert)
+    for block in reader:
+        # csv blocks are sized in bytes, so they are sliced to batch_size rows
+        for start in range(0, block.num_rows, batch_size):
+            batch = block.slice(start, batch_size)
+            yield {name: batch.column(name).to_numpy(zero_copy_only=False)
+                   for name in batch.schema.names}
+
+def score_file(artifact, input_path, output_path, batch_size=1_000_000):
+    '''
+    This function scores every row of a csv or parquet file in batches and writes
+    a csv of parcelid (if the input has it) and prediction. It returns the row count.
+    '''
+    rows = 0
+    with open(output_path, 'w') as out:
+        header_written = False
+        for batch in read_batches(input_path, artifact['columns'], batch_size, optional=[ID_COLUMN]):
+            prediction = score_columns(artifact, {col: batch[col] for col in artifact['columns']})
+            if not header_written:
+                out.write(f'{ID_COLUMN},prediction\n' if ID_COLUMN in batch else 'prediction\n')
+                header_written = True
+            if ID_COLUMN in batch:
+                np.savetxt(out, np.column_stack([batch[ID_COLUMN], prediction]), fmt=['%d', '%.6f'], delimiter=',')
+            else:
+                np.savetxt(out, prediction, fmt='%.6f')
+            rows += len(prediction)
+    return rows
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (4, 5):
+        sys.exit('usage: python score.py ARTIFACT INPUT OUTPUT [BATCH_SIZE]')
+    batch_size = int(sys.argv[4]) if len(sys.argv) == 5 else 1_000_000
+    print(score_file(load_artifact(sys.argv[1]), sys.argv[2], sys.argv[3], batch_size))
@@ -0,0 +1,163 @@
+import numpy as np
+import pandas as pd
+
+class GramStatistics:
+    '''
+    The sufficient statistics of a linear regression: the row count, the column
+    means and the centered cross products X'X, X'y and y'y. They are built in one
+    pass, chunk by chunk if needed, and statistics from different chunks or workers
+    can be merged.
+
+    Every selection method works from these statistics alone, so selecting over
+    dozens of candidate features never touches the rows again:
+
+        - f_regression and select_k_best, as in sklearn's SelectKBest(f_regression)
+        - forward_selection and backward_elimination by residual sum of squares
+        - rfe, which gives the same ranking as sklearn's RFE over LinearRegression,
+          using rank-one downdates of the inverse of X'X instead of refitting
+    '''
+    def __init__(self, columns=None):
+        self.columns = None if columns is None else list(columns)
+        self.n = 0
+
+    def partial_fit(self, X, y):
+        '''
+        This method adds one chunk of X and y to the statistics.
+        '''
+        if isinstance(X, pd.DataFrame) and self.columns is None:
+            self.columns = X.columns.tolist()
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64).ravel()
+        # An empty chunk has NaN means, which would spread into every statistic
+        if len(y) == 0:
+            return self
+
+        mean_x, mean_y = X.mean(axis=0), y.mean()
+        centered_x, centered_y = X - mean_x, y - mean_y
+        chunk = (len(y), mean_x, mean_y, centered_x.T @ centered_x,
+                 centered_x.T @ centered_y, centered_y @ centered_y)
+        self._combine(chunk)
+        return self
+
+    def fit(self, X, y, chunk_size=1_000_000):
+        '''
+        This method builds the statistics from X and y in chunks of chunk_size rows.
+        '''
+        for start in range(0, len(y), chunk_size):
+            rows = slice(start, start + chunk_size)
+            self.partial_fit(X.iloc[rows] if isinstance(X, pd.DataFrame) else X[rows],
+                             y.iloc[rows] if isinstance(y, pd.Series) else y[rows])
+        return self
+
+    def merge(self, other):
+        '''
+        This method merges the statistics of other chunks into these.
+        '''
+        if other.n:
+            if self.columns is None:
+                self.columns = other.columns
+            self._combine((other.n, other.mean_x, other.mean_y, other.xx, other.xy, other.yy))
+        return self
+
+    def _combine(self, chunk):
+        n_b, mean_x_b, mean_y_b, xx_b, xy_b, yy_b = chunk
+        if self.n == 0:
+            self.n, self.mean_x, self.mean_y, self.xx, self.xy, self.yy = n_b, mean_x_b, mean_y_b, xx_b, xy_b, yy_b
+            return
+        n_a, n = self.n, self.n + n_b
+        delta_x, delta_y = mean_x_b - self.mean_x, mean_y_b - self.mean_y
+        weight = n_a * n_b / n
+        self.xx = self.xx + xx_b + weight * np.outer(delta_x, delta_x)
+        self.xy = self.xy + xy_b + weight * delta_x * delta_y
+        self.yy = self.yy + yy_b + weight * delta_y ** 2
+        self.mean_x = self.mean_x + delta_x * n_b / n
+        self.mean_y = self.mean_y + delta_y * n_b / n
+        self.n = n
+
+    def _names(self, positions):
+        names = self.columns if self.columns is not None else list(range(len(self.mean_x)))
+        return [names[i] for i in positions]
+
+    def coefficients(self, features=None):
+        '''
+        This method returns the OLS intercept and coefficients for the given feature
+        positions (all features if None) and the residual sum of squares.
+        '''
+        features = np.arange(len(self.mean_x)) if features is None else np.asarray(features)
+        coef = np.linalg.lstsq(self.xx[np.ix_(features, features)], self.xy[features], rcond=None)[0]
+        intercept = self.mean_y - self.mean_x[features] @ coef
+        return intercept, coef, self.yy - coef @ self.xy[features]
+
+    def f_regression(self):
+        '''
+        This method returns a dataframe with the F statistic and p-value of each
+        feature against the target, the same as sklearn's f_regression.
+        '''
+        from scipy import stats
+
+        correlation = self.xy / np.sqrt(np.diag(self.xx) * self.yy)
+        degrees_of_freedom = self.n - 2
+        f_statistic = correlation ** 2 / (1 - correlation ** 2) * degrees_of_freedom
+        p_value = stats.f.sf(f_statistic, 1, degrees_of_freedom)
+        return pd.DataFrame({'f_statistic': f_statistic, 'p_value': p_value},
+                            index=self._names(range(len(self.mean_x))))
+
+    def select_k_best(self, k):
+        '''
+        This method returns the k features with the highest F statistic.
+        '''
+        scores = self.f_regression().f_statistic
+        return scores.index[np.argsort(-scores.to_numpy(), kind='stable')[:k]].tolist()
+
+    def forward_selection(self, k):
+        '''
+        This method adds features one at a time, each time picking the one that
+        lowers the residual sum of squares the most, and returns the first k picked.
+        '''
+        selected, remaining = [], list(range(len(self.mean_x)))
+        while len(selected) < k and remaining:
+            sse = [self.coefficients(selected + [feature])[2] for feature in remaining]
+            selected.append(remaining.pop(int(np.argmin(sse))))
+        return self._names(selected)
+
+    def _eliminate(self, k, score):
+        '''
+        Removes features one at a time until k are left. score(coef, inverse) returns
+        the value of each remaining feature; the lowest is removed. The inverse of
+        X'X over the remaining features is downdated after each removal.
+        '''
+        remaining = list(range(len(self.mean_x)))
+        inverse = np.linalg.pinv(self.xx)
+        removed = []
+        while len(remaining) > max(k, 0):
+            coef = inverse @ self.xy[remaining]
+            worst = int(np.argmin(score(coef, inverse)))
+            removed.append(remaining.pop(worst))
+
+            # Rank-one downdate: the inverse without row and column worst
+            keep = np.arange(inverse.shape[0]) != worst
+            column = inverse[keep, worst]
+            inverse = inverse[np.ix_(keep, keep)] - np.outer(column, column) / inverse[worst, worst]
+        return remaining, removed
+
+    def backward_elimination(self, k):
+        '''
+        This method removes features one at a time, each time dropping the one whose
+        removal raises the residual sum of squares the least, and returns the k left.
+        '''
+        # Removing feature j raises the residual sum of squares by coef_j ** 2 / inverse_jj
+        remaining, _ = self._eliminate(k, lambda coef, inverse: coef ** 2 / np.diag(inverse))
+        return self._names(remaining)
+
+    def rfe(self, k):
+        '''
+        This method does recursive feature elimination for a linear regression:
+        refit, drop the feature with the smallest absolute coefficient, repeat until
+        k features are left. It returns the k features and a ranking like sklearn's
+        RFE.ranking_ (1 for the selected features, higher for earlier removals).
+        '''
+        remaining, removed = self._eliminate(k, lambda coef, inverse: np.abs(coef))
+        ranking = np.ones(len(self.mean_x), dtype=int)
+        for rank, feature in enumerate(reversed(removed), start=2):
+            ranking[feature] = rank
+        return self._names(remaining), pd.Series(ranking, index=self._names(range(len(self.mean_x))))
@@ -0,0 +1,295 @@
+'''
+A local asyncio HTTP service that scores single parcels with an inference artifact
+(see modeling.build_artifact and score.py), plus a load generator to exercise it:
+
+    python service.py serve model.npz --port 8080
+    python service.py loadgen parcels.csv --port 8080 --requests 20000 --concurrency 64
+
+Concurrent requests are collected into micro-batches and scored with one
+vectorized call per batch. GET /metrics returns latency and throughput counters.
+'''
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+import numpy as np
+
+import score
+
+class MicroBatcher:
+    '''
+    Collects single records into batches of at most max_batch_size, waiting at most
+    max_wait seconds after the first record of a batch, and scores every batch with
+    one call to score_batch(records) -> predictions.
+
+    It keeps the latency of the last window requests for the p50/p99 counters.
+    '''
+    def __init__(self, score_batch, max_batch_size=256, max_wait=0.002, window=10_000):
+        self.score_batch = score_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+        self.started = time.perf_counter()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    async def submit(self, record):
+        '''
+        This method queues one record and waits for its prediction.
+        '''
+        future = asyncio.get_running_loop().create_future()
+        start = time.perf_counter()
+        await self.queue.put((record, future))
+        prediction = await future
+        self.latencies.append(time.perf_counter() - start)
+        return prediction
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            records, futures = zip(*batch)
+            try:
+                predictions = self.score_batch(list(records))
+                if len(predictions) != len(futures):
+                    raise RuntimeError(f'{len(predictions)} predictions for {len(futures)} records')
+            except Exception as error:
+                predictions, failure = None, error
+            # A future is already done if its request was cancelled (client gone,
+            # timeout or shutdown); setting it again would kill this loop
+            for i, future in enumerate(futures):
+                if future.done():
+                    continue
+                if predictions is None:
+                    future.set_exception(failure)
+                else:
+                    future.set_result(predictions[i])
+            if predictions is not None:
+                self.requests += len(batch)
+                self.batches += 1
+
+    def stats(self):
+        '''
+        This method returns the latency percentiles (in milliseconds), throughput
+        and batching counters.
+        '''
+        latencies = np.array(self.latencies) * 1000
+        elapsed = time.perf_counter() - self.started
+        return {
+            'requests': self.requests,
+            'batches': self.batches,
+            'mean_batch_size': self.requests / self.batches if self.batches else 0.0,
+            'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            'requests_per_second': self.requests / elapsed if elapsed else 0.0,
+        }
+
+
+def artifact_row(artifact, record):
+    '''
+    This function validates one request body (a dict of raw column values) and
+    returns its values of the artifact's columns as a float array, missing or null
+    values as NaN. It raises TypeError or ValueError for a body that is not a json
+    object or a value that is not a number, so the request can be rejected before
+    it joins a batch.
+    '''
+    if not isinstance(record, dict):
+        raise TypeError(f'expected a json object of column values, got {type(record).__name__}')
+    row = np.empty(len(artifact['columns']), dtype=np.float64)
+    for i, col in enumerate(artifact['columns']):
+        value = record.get(col)
+        try:
+            row[i] = np.nan if value is None else float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f'{col} must be a number, got {value!r}') from None
+    return row
+
+def artifact_scorer(artifact):
+    '''
+    This function returns a score_batch function for MicroBatcher that scores a list
+    of rows (see artifact_row) with an artifact in one vectorized call. Missing
+    predictions are returned as None.
+    '''
+    def score_batch(rows):
+        values = np.vstack(rows)
+        columns = {col: values[:, i] for i, col in enumerate(artifact['columns'])}
+        predictions = score.score_columns(artifact, columns)
+        return [None if np.isnan(prediction) else float(prediction) for prediction in predictions]
+    return score_batch
+
+
+async def _read_message(reader):
+    '''
+    Reads one HTTP/1.1 request or response and returns its first line, headers and
+    body, or None if the connection was closed. A malformed header or
+    Content-Length raises a ValueError.
+    '''
+    first_line = await reader.readline()
+    if not first_line:
+        return None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length < 0:
+        raise ValueError(f'invalid content-length {length}')
+    body = await reader.readexactly(length)
+    return first_line.decode('latin-1'), headers, body
+
+def _response(status, payload, keep_alive=True):
+    body = json.dumps(payload).encode()
+    head = (f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: {"keep-alive" if keep_alive else "close"}\r\n\r\n')
+    return head.encode() + body
+
+async def serve(artifact_path, host='127.0.0.1', port=8080, max_batch_size=256, max_wait=0.002):
+    '''
+    This function runs the scoring service until it is cancelled:
+
+        POST /predict  body: a json object of raw column values -> {"prediction": value}
+        GET  /metrics  latency percentiles, throughput and batching counters
+        GET  /health   {"status": "ok"}
+    '''
+    artifact = score.load_artifact(artifact_path)
+    batcher = MicroBatcher(artifact_scorer(artifact), max_batch_size, max_wait).start()
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await _read_message(reader)
+                    if request is None:
+                        break
+                    request_line, headers, body = request
+                    method, path, _ = request_line.split(' ', 2)
+                except ValueError as error:
+                    # The rest of the stream cannot be trusted after a malformed message
+                    writer.write(_response('400 Bad Request', {'error': f'malformed request: {error}'},
+                                           keep_alive=False))
+                    await writer.drain()
+                    break
+                keep_alive = headers.get('connection', 'keep-alive').lower() != 'close'
+                if method == 'POST' and path == '/predict':
+                    # A bad body is rejected on its own, before it can fail a batch
+                    try:
+                        row = artifact_row(artifact, json.loads(body))
+                    except (ValueError, TypeError) as error:
+                        response = _response('400 Bad Request', {'error': str(error)}, keep_alive)
+                    else:
+                        try:
+                            prediction = await batcher.submit(row)
+                            response = _response('200 OK', {'prediction': prediction}, keep_alive)
+                        except Exception as error:
+                            response = _response('500 Internal Server Error', {'error': str(error)}, keep_alive)
+                elif method == 'GET' and path == '/metrics':
+                    response = _response('200 OK', batcher.stats(), keep_alive)
+                elif method == 'GET' and path == '/health':
+                    response = _response('200 OK', {'status': 'ok'}, keep_alive)
+                else:
+                    response = _response('404 Not Found', {'error': f'no route for {method} {path}'}, keep_alive)
+                writer.write(response)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+async def _client(host, port, records, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for record in records:
+            body = json.dumps(record).encode()
+            start = time.perf_counter()
+            writer.write(f'POST /predict HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\n\r\n'.encode()
+                         + body)
+            await writer.drain()
+            await _read_message(reader)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+async def run_load(records, host='127.0.0.1', port=8080, requests=10_000, concurrency=64):
+    '''
+    This function sends requests single-parcel requests (cycling through records, a
+    list of dicts of raw column values) over concurrency keep-alive connections and
+    returns the client side latency percentiles (ms) and throughput.
+    '''
+    latencies = []
+    per_client = [[records[i % len(records)] for i in range(client, requests, concurrency)]
+                  for client in range(concurrency)]
+    start = time.perf_counter()
+    await asyncio.gather(*(_client(host, port, client_records, latencies) for client_records in per_client))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+    }
+
+def read_records(path, limit=10_000):
+    '''
+    This function reads up to limit rows of a csv or parquet file as a list of dicts
+    of float values, for the load generator.
+    '''
+    import pandas as pd
+
+    df = pd.read_parquet(path) if path.endswith('.parquet') else pd.read_csv(path, nrows=limit)
+    df = df.head(limit).select_dtypes('number')
+    return [{col: value for col, value in row.items() if not np.isnan(value)}
+            for row in df.to_dict(orient='records')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-batching property value scoring service')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help='run the scoring service')
+    serve_parser.add_argument('artifact')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    serve_parser.add_argument('--max-batch-size', type=int, default=256)
+    serve_parser.add_argument('--max-wait', type=float, default=0.002, help='seconds')
+    load_parser = commands.add_parser('loadgen', help='send single-parcel requests to a running service')
+    load_parser.add_argument('records', help='csv or parquet file of raw parcels')
+    load_parser.add_argument('--host', default='127.0.0.1')
+    load_parser.add_argument('--port', type=int, default=8080)
+    load_parser.add_argument('--requests', type=int, default=10_000)
+    load_parser.add_argument('--concurrency', type=int, default=64)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        asyncio.run(serve(args.artifact, args.host, args.port, args.max_batch_size, args.max_wait))
+    else:
+        print(json.dumps(asyncio.run(run_load(read_records(args.records), args.host, args.port,
+                                              args.requests, args.concurrency)), indent=2))
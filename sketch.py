@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+
+class QuantileSketch:
+    '''
+    A mergeable KLL quantile sketch. It takes values in batches, keeps at most a few
+    times k of them no matter how many it has seen, and two sketches built on
+    different chunks or by different workers can be merged into one.
+
+    While fewer values than the sketch's capacity have been seen, quantiles are exact
+    (the same as np.quantile). After that, a quantile returned for q has a rank within
+    about 2.3 / k ** 0.97 * n of q * n with high probability: about 1.3% of n for the
+    default k=200 and 0.3% for k=1000.
+    '''
+    def __init__(self, k=200, seed=123):
+        self.k = k
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, values):
+        '''
+        This method adds a batch of values to the sketch, ignoring missing values.
+        '''
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        self.n += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other):
+        '''
+        This method merges another sketch into this one and returns this one.
+        '''
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for h, level in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], level])
+        self.n += other.n
+        self._compress()
+        return self
+
+    def is_exact(self):
+        '''
+        This method returns True if no values have been compacted away yet.
+        '''
+        return all(len(level) == 0 for level in self.levels[1:])
+
+    def weighted_items(self):
+        '''
+        This method returns the values the sketch holds, sorted, and the number of
+        seen values each one stands for.
+        '''
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2 ** h, dtype=np.int64)
+                                  for h, level in enumerate(self.levels)])
+        order = np.argsort(items, kind='mergesort')
+        return items[order], weights[order]
+
+    def quantile(self, q):
+        '''
+        This method returns the estimated quantile(s) q of every value seen so far.
+        '''
+        if self.n == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        if self.is_exact():
+            return np.quantile(self.levels[0], q)
+
+        items, weights = self.weighted_items()
+        cumulative = np.cumsum(weights)
+
+        # Item whose block of ranks covers the 0-based rank q * (n - 1)
+        ranks = np.asarray(q) * (cumulative[-1] - 1)
+        return items[np.searchsorted(cumulative, ranks, side='right')]
+
+    def histogram(self, bins=10, range=None):
+        '''
+        This method returns the counts and bin edges of a histogram of every value
+        seen so far, like np.histogram. Counts are exact while the sketch is exact;
+        after that they are estimates with the same rank error as quantile, scaled
+        so they add up to the number of values seen.
+        '''
+        items, weights = self.weighted_items()
+        counts, edges = np.histogram(items, bins=bins, range=range, weights=weights)
+        if not self.is_exact() and counts.sum() > 0:
+            counts = counts * (self.n / weights.sum())
+        return counts, edges
+
+    def _capacity(self, h):
+        return max(2, int(np.ceil(self.k * (2 / 3) ** (len(self.levels) - 1 - h))))
+
+    def _compress(self):
+        while sum(len(level) for level in self.levels) > sum(self._capacity(h) for h in range(len(self.levels))):
+            h = next(h for h, level in enumerate(self.levels) if len(level) >= self._capacity(h))
+            if h + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+
+            level = np.sort(self.levels[h])
+            # With an odd count one value stays behind at this level
+            keep, level = level[:len(level) % 2], level[len(level) % 2:]
+            offset = self.rng.integers(2)
+            self.levels[h + 1] = np.concatenate([self.levels[h + 1], level[offset::2]])
+            self.levels[h] = keep
+
+
+class IQRFilter:
+    '''
+    A single pass, multi-column IQR outlier filter that works on streamed chunks.
+
+    The first pass (partial_fit, once per chunk) feeds every column into its own
+    QuantileSketch. Filters fit on different chunks by parallel workers can be
+    combined with merge. The second pass (transform, once per chunk) applies all
+    cutoffs with one combined row mask.
+
+    columns is a dict of {col: (k, lower)}: rows at or above q3 + k * iqr are
+    dropped, and with lower=True rows at or below q1 - k * iqr as well. The
+    default matches remove_tax_value_outliers and remove_square_feet_outliers.
+    Unlike calling those one after the other, every quantile here is taken over
+    the same rows.
+    '''
+    def __init__(self, columns=None, sketch_k=200, seed=123):
+        if columns is None:
+            columns = {'taxvaluedollarcnt': (3, False), 'calculatedfinishedsquarefeet': (3, True)}
+        self.columns = dict(columns)
+        self.sketches = {col: QuantileSketch(sketch_k, seed=seed) for col in self.columns}
+
+    def partial_fit(self, df):
+        '''
+        This method updates the sketches with one chunk of data.
+        '''
+        for col, sketch in self.sketches.items():
+            sketch.update(df[col].to_numpy())
+        return self
+
+    def fit(self, chunks):
+        '''
+        This method makes the first pass over an iterable of chunks (or a single dataframe).
+        '''
+        if isinstance(chunks, pd.DataFrame):
+            chunks = [chunks]
+        for chunk in chunks:
+            self.partial_fit(chunk)
+        return self
+
+    def merge(self, other):
+        '''
+        This method merges the sketches of a filter fit on other chunks into this one.
+        '''
+        for col, sketch in self.sketches.items():
+            sketch.merge(other.sketches[col])
+        return self
+
+    @property
+    def cutoffs_(self):
+        '''
+        A dict of {col: (lower, upper)} cutoffs. lower is -inf for upper-only columns.
+        '''
+        cutoffs = {}
+        for col, (k, lower) in self.columns.items():
+            q1, q3 = self.sketches[col].quantile([.25, .75])
+            iqr = q3 - q1
+            cutoffs[col] = (q1 - k * iqr if lower else -np.inf, q3 + k * iqr)
+        return cutoffs
+
+    def mask(self, df):
+        '''
+        This method returns a boolean array of the rows of df within every cutoff.
+        '''
+        mask = np.ones(len(df), dtype=bool)
+        for col, (lower, upper) in self.cutoffs_.items():
+            values = df[col].to_numpy()
+            mask &= (values > lower) & (values < upper)
+        return mask
+
+    def transform(self, df):
+        '''
+        This method returns the rows of one chunk that are within every cutoff.
+        '''
+        return df[self.mask(df)]
+
+    def filter(self, chunks):
+        '''
+        This method makes the second pass, yielding each chunk with its outliers removed.
+        '''
+        for chunk in chunks:
+            yield self.transform(chunk)
@@ -0,0 +1,146 @@
+import numpy as np
+import pandas as pd
+
+# Mean earth radius in km
+EARTH_RADIUS_KM = 6371.0
+
+def project_coordinates(latitude, longitude, reference_latitude=34.0):
+    '''
+    This function projects latitude and longitude in degrees (as formatted by
+    prepare.get_latitude and prepare.get_longitude) to x and y in km with an
+    equirectangular projection around reference_latitude. Over the three counties
+    distances are within a fraction of a percent of great circle distances.
+    It returns an (n, 2) array.
+    '''
+    latitude = np.radians(np.asarray(latitude, dtype=np.float64))
+    longitude = np.radians(np.asarray(longitude, dtype=np.float64))
+    return np.column_stack([EARTH_RADIUS_KM * np.cos(np.radians(reference_latitude)) * longitude,
+                            EARTH_RADIUS_KM * latitude])
+
+class NeighborhoodIndex:
+    '''
+    A KD-tree over the projected coordinates of the training parcels that adds
+    neighborhood "comps" features to any frame:
+
+        knn_median_<col>     median of col over the k nearest training parcels
+        knn_mean_distance    mean distance in km to those k parcels
+        radius_median_<col>  median of col over the training parcels within radius km
+                             (the nearest max_neighbors of them)
+        radius_count         how many training parcels are within radius km,
+                             capped at max_neighbors
+
+    Only training parcels are ever neighbors, so validate and test targets never
+    leak into the features. fit_transform excludes each training parcel from its
+    own neighbors. Building the tree is O(n log n) and each query O(log n), and
+    rows are queried in batches of batch_size so memory stays bounded.
+    '''
+    def __init__(self, k=10, radius=1.0, max_neighbors=50, columns=('taxvaluedollarcnt', 'tax_rate'),
+                 batch_size=100_000, reference_latitude=34.0):
+        self.k = k
+        self.radius = radius
+        self.max_neighbors = max_neighbors
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self.reference_latitude = reference_latitude
+        self.tree = None
+
+    def _points(self, df):
+        return project_coordinates(df['latitude'], df['longitude'], self.reference_latitude)
+
+    def fit(self, train):
+        '''
+        This method builds the tree from the training parcels. Parcels without
+        coordinates are left out.
+        '''
+        from scipy.spatial import cKDTree
+
+        points = self._points(train)
+        located = np.isfinite(points).all(axis=1)
+        self.positions_ = np.flatnonzero(located)
+        self.values_ = train[self.columns].to_numpy(dtype=np.float64)[located]
+        self.tree = cKDTree(points[located])
+        return self
+
+    def _query(self, points, k, rows=None):
+        '''
+        Returns the distances and tree positions of the k nearest training parcels
+        of each point. If rows (tree positions of the points themselves) is given,
+        each point is left out of its own neighbors.
+        '''
+        distances, neighbors = self.tree.query(points, k=k if rows is None else k + 1, workers=-1)
+        distances, neighbors = distances.reshape(len(points), -1), neighbors.reshape(len(points), -1)
+        if rows is not None:
+            # Drop the point itself, or the farthest neighbor if the point tied
+            # with other parcels at the same location and fell off the end
+            own = neighbors == rows[:, np.newaxis]
+            own[~own.any(axis=1), -1] = True
+            distances = distances[~own].reshape(len(points), k)
+            neighbors = neighbors[~own].reshape(len(points), k)
+        return distances, neighbors
+
+    def _median(self, neighbors):
+        '''
+        Returns the median of every column over each row of neighbor positions,
+        ignoring missing values. Position n stands for no neighbor.
+        '''
+        values = np.vstack([self.values_, np.full((1, len(self.columns)), np.nan)])
+        found = np.minimum(neighbors, len(self.values_))
+        # (columns, rows, neighbors), sorted with NaN last, then the middle of the
+        # non-missing values of each row (much faster than np.nanmedian)
+        gathered = np.sort(values.T[:, found], axis=2)
+        count = (~np.isnan(gathered)).sum(axis=2, keepdims=True)
+        low = np.take_along_axis(gathered, np.maximum(count - 1, 0) // 2, axis=2)
+        high = np.take_along_axis(gathered, np.minimum(count // 2, gathered.shape[2] - 1), axis=2)
+        median = np.where(count > 0, (low + high) / 2, np.nan)
+        return median[:, :, 0].T
+
+    def _features(self, points, rows=None):
+        # One query serves both the k nearest and the radius features
+        width = max(self.k, self.max_neighbors if self.radius is not None else 0)
+        distances, neighbors = self._query(points, width, rows)
+
+        features = {}
+        medians = self._median(neighbors[:, :self.k])
+        for i, col in enumerate(self.columns):
+            features[f'knn_median_{col}'] = medians[:, i]
+        features['knn_mean_distance'] = distances[:, :self.k].mean(axis=1)
+
+        if self.radius is not None:
+            within = distances[:, :self.max_neighbors] <= self.radius
+            medians = self._median(np.where(within, neighbors[:, :self.max_neighbors], len(self.values_)))
+            for i, col in enumerate(self.columns):
+                features[f'radius_median_{col}'] = medians[:, i]
+            features['radius_count'] = within.sum(axis=1)
+        return features
+
+    def transform(self, df, exclude_self=False):
+        '''
+        This method returns a dataframe of neighborhood features for every row of
+        df, with the same index. exclude_self must only be used when df is the
+        frame the index was fit on. Rows without coordinates get NaN features.
+        '''
+        points = self._points(df)
+        located = np.flatnonzero(np.isfinite(points).all(axis=1))
+        if exclude_self:
+            # Tree position of every located row of the training frame
+            tree_rows = np.full(len(df), -1)
+            tree_rows[self.positions_] = np.arange(len(self.positions_))
+
+        batches = []
+        for start in range(0, len(located), self.batch_size):
+            rows = located[start:start + self.batch_size]
+            batches.append(self._features(points[rows], tree_rows[rows] if exclude_self else None))
+
+        features = pd.DataFrame(index=df.index)
+        for name in batches[0] if batches else []:
+            column = np.full(len(df), np.nan)
+            column[located] = np.concatenate([batch[name] for batch in batches])
+            features[name] = column
+        return features
+
+    def fit_transform(self, train):
+        '''
+        This method fits the index on the training parcels and returns their
+        features, each parcel excluded from its own neighbors.
+        '''
+        return self.fit(train).transform(train, exclude_self=True)
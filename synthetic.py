@@ -0,0 +1,179 @@
+'''
+Seeded synthetic Zillow data with the schema of the CodeUp zillow db, for
+benchmarks and for running the pipeline without the database.
+
+zillow_frame returns a dataframe like acquire.new_zillow_data, and populate_sqlite
+writes the properties_2017, predictions_2017 and propertylandusetype tables to a
+local SQLite file that acquire can read through its con argument:
+
+    python synthetic.py zillow.db 50000000
+
+    con = 'sqlite:///zillow.db'
+    df = acquire.new_zillow_data(con=con)
+
+Rows are generated in chunks of chunk_size, each from its own seed, so memory is
+bounded by one chunk and the same seed and chunk_size always give the same rows.
+'''
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from acquire import ZILLOW_SCHEMA, set_zillow_dtypes
+
+# Land use types of the zillow db. Rows with the types not selected by
+# acquire.get_zillow_query (condominiums, duplexes, ...) are generated as well.
+LAND_USE_TYPES = {
+    246: 'Duplex (2 Units, Any Combination)',
+    247: 'Triplex (3 Units, Any Combination)',
+    260: 'Residential General',
+    261: 'Single Family Residential',
+    262: 'Rural Residence',
+    263: 'Mobile Home',
+    264: 'Townhouse',
+    265: 'Cluster Home',
+    266: 'Condominium',
+    268: 'Row House',
+    269: 'Planned Unit Development',
+    273: 'Bungalow',
+    275: 'Manufactured, Modular, Prefabricated Homes',
+    276: 'Patio Home',
+    279: 'Inferred Single Family Residential',
+}
+LAND_USE_SHARES = [0.03, 0.01, 0.02, 0.695, 0.005, 0.01, 0.01, 0.01, 0.13, 0.005, 0.05, 0.005, 0.01, 0.005, 0.005]
+
+# fips: (share of parcels, latitude center and spread, longitude center and spread,
+# price per square foot multiplier)
+COUNTIES = {
+    6037: (0.64, 34.05, 0.25, -118.25, 0.30, 1.0),
+    6059: (0.27, 33.70, 0.12, -117.85, 0.12, 1.2),
+    6111: (0.09, 34.25, 0.12, -119.10, 0.15, 0.9),
+}
+
+# Share of missing values in the nullable columns
+MISSING_SHARES = {
+    'calculatedbathnbr': 0.03,
+    'calculatedfinishedsquarefeet': 0.005,
+    'structuretaxvaluedollarcnt': 0.005,
+    'taxvaluedollarcnt': 0.001,
+    'landtaxvaluedollarcnt': 0.001,
+    'taxamount': 0.003,
+}
+
+FIRST_PARCELID = 10_000_000
+
+def make_chunk(n, start=0, seed=123, chunk=0):
+    '''
+    This function returns one chunk of n synthetic parcels as two dataframes, the
+    properties_2017 rows and their predictions_2017 rows (one transaction each).
+    Parcel ids start at FIRST_PARCELID + start.
+    '''
+    rng = np.random.default_rng([seed, chunk])
+    fips_codes = np.array(list(COUNTIES))
+    county = rng.choice(len(fips_codes), n, p=[spec[0] for spec in COUNTIES.values()])
+    spec = np.array([spec[1:] for spec in COUNTIES.values()])[county]
+
+    bedrooms = rng.choice(np.arange(8), n, p=[0.01, 0.06, 0.25, 0.38, 0.2, 0.07, 0.02, 0.01])
+    bathrooms = np.maximum(1.0, np.round((bedrooms * 0.7 + rng.normal(0.3, 0.6, n)) * 2) / 2)
+    square_feet = np.round(rng.lognormal(np.log(900 + 350 * bedrooms), 0.3))
+    tax_value = np.maximum(1000.0, np.round(square_feet * spec[:, 4] * rng.lognormal(np.log(250), 0.5, n)))
+    land_value = np.round(tax_value * rng.uniform(0.3, 0.7, n))
+    tax_rate = np.maximum(0.005, rng.normal(0.0122, 0.0015, n))
+
+    properties = pd.DataFrame({
+        'parcelid': FIRST_PARCELID + start + np.arange(n, dtype=np.int64),
+        'bathroomcnt': bathrooms,
+        'bedroomcnt': bedrooms.astype(np.float64),
+        'calculatedbathnbr': bathrooms,
+        'calculatedfinishedsquarefeet': square_feet,
+        'fips': fips_codes[county].astype(np.float64),
+        # Raw coordinates are stored as integer millionths of a degree
+        'latitude': np.round((spec[:, 0] + rng.normal(0, 1, n) * spec[:, 1]) * 1e6),
+        'longitude': np.round((spec[:, 2] + rng.normal(0, 1, n) * spec[:, 3]) * 1e6),
+        'structuretaxvaluedollarcnt': tax_value - land_value,
+        'taxvaluedollarcnt': tax_value,
+        'landtaxvaluedollarcnt': land_value,
+        'taxamount': np.round(tax_value * tax_rate + 50, 2),
+        'propertylandusetypeid': rng.choice(list(LAND_USE_TYPES), n, p=LAND_USE_SHARES).astype(np.float64),
+    })
+    for col, share in MISSING_SHARES.items():
+        properties.loc[rng.random(n) < share, col] = np.nan
+
+    days = rng.integers(0, 258, n)
+    predictions = pd.DataFrame({
+        'parcelid': properties['parcelid'],
+        'logerror': rng.normal(0, 0.16, n),
+        'transactiondate': (np.datetime64('2017-01-01') + days).astype(str),
+    })
+    return properties, predictions
+
+def make_chunks(n, chunk_size=1_000_000, seed=123):
+    '''
+    This function yields (properties, predictions) chunks of at most chunk_size
+    parcels until n parcels have been made.
+    '''
+    for chunk, start in enumerate(range(0, n, chunk_size)):
+        yield make_chunk(min(chunk_size, n - start), start, seed, chunk)
+
+def zillow_frame(n, seed=123, chunk_size=1_000_000, start_date='2017-05-01', end_date='2017-08-31'):
+    '''
+    This function returns what acquire.new_zillow_data would read from a db
+    populated with the same n parcels: the parcels with a selected land use and a
+    transaction between start_date and end_date, typed with acquire.ZILLOW_SCHEMA.
+    Rows are in parcelid order. The query has no ORDER BY, so the db may return
+    them in another order; compare the two after sorting by parcelid.
+    '''
+    from acquire import get_zillow_query
+
+    # The land use ids the query selects, read from the query itself
+    query = get_zillow_query(start_date, end_date)
+    selected = [int(code) for code in query.split('propertylandusetypeid IN (')[1].split(')')[0].split(',')]
+
+    frames = []
+    for properties, predictions in make_chunks(n, chunk_size, seed):
+        keep = (properties['propertylandusetypeid'].isin(selected)
+                & predictions['transactiondate'].between(start_date, end_date))
+        frame = properties[keep]
+        frames.append(frame.assign(propertylandusedesc=frame['propertylandusetypeid'].astype(int).map(LAND_USE_TYPES)))
+    df = pd.concat(frames, ignore_index=True)
+    return set_zillow_dtypes(df[[col for col in ZILLOW_SCHEMA if col in df]])
+
+def populate_sqlite(path, n, chunk_size=1_000_000, seed=123):
+    '''
+    This function writes n synthetic parcels to the properties_2017,
+    predictions_2017 and propertylandusetype tables of a SQLite file (replacing
+    the file if it exists), chunk by chunk, and returns a sqlalchemy url for it
+    that can be passed to acquire as con.
+    '''
+    if os.path.exists(path):
+        os.remove(path)
+    properties_columns = list(make_chunk(1)[0].columns)
+    with sqlite3.connect(path) as conn:
+        # Nothing is gained by a journal while the whole file is being built
+        conn.execute('PRAGMA journal_mode = OFF')
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('CREATE TABLE propertylandusetype (propertylandusetypeid INTEGER PRIMARY KEY, '
+                     'propertylandusedesc TEXT)')
+        conn.executemany('INSERT INTO propertylandusetype VALUES (?, ?)', LAND_USE_TYPES.items())
+        conn.execute('CREATE TABLE properties_2017 (parcelid INTEGER PRIMARY KEY, '
+                     + ', '.join(f'{col} REAL' for col in properties_columns[1:]) + ')')
+        conn.execute('CREATE TABLE predictions_2017 (parcelid INTEGER, logerror REAL, transactiondate TEXT)')
+
+        placeholders = ', '.join('?' * len(properties_columns))
+        for properties, predictions in make_chunks(n, chunk_size, seed):
+            # NaN is stored as NULL
+            conn.executemany(f'INSERT INTO properties_2017 VALUES ({placeholders})',
+                             properties.astype(object).itertuples(index=False, name=None))
+            conn.executemany('INSERT INTO predictions_2017 VALUES (?, ?, ?)',
+                             predictions.astype(object).itertuples(index=False, name=None))
+        conn.execute('CREATE INDEX predictions_2017_transactiondate ON predictions_2017 (transactiondate)')
+        conn.execute('CREATE INDEX predictions_2017_parcelid ON predictions_2017 (parcelid)')
+    return f'sqlite:///{os.path.abspath(path)}'
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) not in (3, 4):
+        sys.exit('usage: python synthetic.py DB_PATH ROWS [SEED]')
+    print(populate_sqlite(sys.argv[1], int(sys.argv[2]), seed=int(sys.argv[3]) if len(sys.argv) == 4 else 123))
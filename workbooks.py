@@ -0,0 +1,222 @@
+'''
+Typed parquet caches for the Excel workbooks shipped with the project
+(zillow_tax_rate_by_county.xlsx and glm_model_predictions.xlsx).
+
+Each workbook is parsed with openpyxl once, cast to a schema and written to a
+parquet file with a json manifest holding a hash of the workbook, so later loads
+skip Excel entirely and the cache is rebuilt only when the workbook changes:
+
+    python workbooks.py
+
+Rows of the tax rate workbook are stored one row group per county, so reading a
+single county only touches that county's rows. The per-county tax rate aggregates
+are written next to it and loaded into a CountyIndex for lookups and joins by
+county name or fips code.
+'''
+import os
+import hashlib
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+
+from acquire import read_manifest, write_manifest
+from prepare import COUNTY_BY_FIPS
+
+FIPS_BY_COUNTY = {county: fips for fips, county in COUNTY_BY_FIPS.items()}
+
+TAX_RATE_WORKBOOK = 'zillow_tax_rate_by_county.xlsx'
+PREDICTIONS_WORKBOOK = 'glm_model_predictions.xlsx'
+
+WORKBOOK_SCHEMAS = {
+    TAX_RATE_WORKBOOK: {
+        'parcelid': 'int64',
+        'bathroomcnt': 'float64',
+        'bedroomcnt': 'int16',
+        'calculatedfinishedsquarefeet': 'int32',
+        'latitude': 'float64',
+        'longitude': 'float64',
+        'taxvaluedollarcnt': 'int64',
+        'propertylandusedesc': 'category',
+        'county': pd.CategoricalDtype(list(FIPS_BY_COUNTY)),
+        'tax_rate': 'float64',
+        'bath_per_sqft': 'float64',
+    },
+    PREDICTIONS_WORKBOOK: {
+        'parcelid': 'int64',
+        'taxvaluedollarcnt': 'int64',
+        'yhat_baseline': 'float64',
+        'yhat_glm': 'float64',
+        'residual': 'float64',
+        'baseline_residual': 'float64',
+    },
+}
+
+# Quantiles kept for every county in the aggregates
+COUNTY_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+def get_cache_filename(workbook):
+    '''
+    This function returns the parquet cache filename for a workbook.
+    '''
+    return os.path.splitext(workbook)[0] + '.parquet'
+
+def get_stats_filename(workbook):
+    '''
+    This function returns the filename of the per-county aggregates for a workbook.
+    '''
+    return os.path.splitext(workbook)[0] + '.stats.parquet'
+
+def get_source_hash(workbook):
+    '''
+    This function returns a sha256 hash of the workbook's bytes.
+    '''
+    with open(workbook, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def workbook_is_fresh(workbook):
+    '''
+    This function checks whether the parquet cache of a workbook can be used. It is
+    stale if the cache or its manifest is missing or the workbook has changed since
+    it was converted. If only the cache exists (the workbook was not shipped) it is
+    used as is.
+    '''
+    filename = get_cache_filename(workbook)
+    manifest = read_manifest(filename)
+    if manifest is None or not os.path.isfile(filename):
+        return False
+    if os.path.isfile(workbook) and manifest['source_hash'] != get_source_hash(workbook):
+        return False
+    return True
+
+
+def county_stats(df, value='tax_rate', quantiles=COUNTY_QUANTILES):
+    '''
+    This function takes in a dataframe with a county or fips column (such as the
+    output of prepare.calculate_tax_rate) and returns a dataframe indexed by county
+    with the fips code and the count, mean, std, min, quantiles and max of value.
+    '''
+    county = df['county'] if 'county' in df else df['fips'].map(COUNTY_BY_FIPS)
+    grouped = df[value].groupby(np.asarray(county, dtype=object), sort=True)
+
+    stats = grouped.agg(['count', 'mean', 'std', 'min', 'max'])
+    quantile_table = grouped.quantile(list(quantiles)).unstack()
+    quantile_table.columns = [f'q{round(q * 100):02d}' for q in quantiles]
+    stats = pd.concat([stats.drop(columns='max'), quantile_table, stats[['max']]], axis=1)
+
+    stats.insert(0, 'fips', stats.index.map(FIPS_BY_COUNTY).astype('int16'))
+    stats.index.name = 'county'
+    return stats
+
+class CountyIndex:
+    '''
+    Per-county aggregates (see county_stats) with O(1) lookups by county name or
+    fips code, and joins that look each row's county up in a hash index instead
+    of merging.
+    '''
+    def __init__(self, stats):
+        self.stats = stats
+        self._rows = {}
+        for county, row in stats.iterrows():
+            self._rows[county] = self._rows[int(row['fips'])] = row.to_dict()
+
+    @classmethod
+    def from_frame(cls, df, value='tax_rate', quantiles=COUNTY_QUANTILES):
+        '''
+        This method builds the index from rows with a county or fips column.
+        '''
+        return cls(county_stats(df, value, quantiles))
+
+    @classmethod
+    def load(cls, workbook=TAX_RATE_WORKBOOK):
+        '''
+        This method loads the aggregates of a workbook, converting it first if the
+        cache is stale.
+        '''
+        if not workbook_is_fresh(workbook) or not os.path.isfile(get_stats_filename(workbook)):
+            convert_workbook(workbook)
+        return cls(pd.read_parquet(get_stats_filename(workbook)))
+
+    def lookup(self, key):
+        '''
+        This method returns the aggregates of one county as a dict. key is a county
+        name or a fips code.
+        '''
+        return self._rows[key]
+
+    def join(self, df, columns=None, prefix='county_'):
+        '''
+        This method returns df with the aggregates of each row's county added as
+        columns named prefix + aggregate. Rows are matched on the county column if
+        df has one, otherwise on fips. Rows with an unknown county get NaN.
+        '''
+        columns = [col for col in self.stats.columns if col != 'fips'] if columns is None else columns
+        if 'county' in df:
+            positions = self.stats.index.get_indexer(np.asarray(df['county'], dtype=object))
+        else:
+            positions = pd.Index(self.stats['fips'].astype('int64')).get_indexer(df['fips'].astype('int64'))
+
+        values = self.stats[columns].to_numpy(dtype=np.float64)
+        joined = np.where((positions >= 0)[:, np.newaxis], values[positions], np.nan)
+        return df.assign(**{prefix + col: joined[:, i] for i, col in enumerate(columns)})
+
+
+def convert_workbook(workbook, schema=None):
+    '''
+    This function parses a workbook once, casts it to its schema (from
+    WORKBOOK_SCHEMAS unless given) and writes the parquet cache and manifest.
+    Workbooks with a county column also get a fips column, one row group per
+    county and a file of per-county tax rate aggregates. It returns the dataframe.
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = WORKBOOK_SCHEMAS.get(os.path.basename(workbook), {}) if schema is None else schema
+    df = pd.read_excel(workbook, engine='openpyxl')
+    df = df.astype({col: dtype for col, dtype in schema.items() if col in df})
+
+    filename = get_cache_filename(workbook)
+    manifest = {
+        'source': os.path.basename(workbook),
+        'source_hash': get_source_hash(workbook),
+        'rows': int(len(df)),
+        'converted_at': datetime.now(timezone.utc).isoformat(),
+    }
+    if 'county' in df:
+        df['fips'] = df['county'].map(FIPS_BY_COUNTY).astype('int16')
+        df = df.sort_values(['county', 'parcelid'], kind='mergesort', ignore_index=True)
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        bounds = np.flatnonzero(np.diff(df['county'].cat.codes.to_numpy(), prepend=-1, append=-1))
+        with pq.ParquetWriter(filename, table.schema) as writer:
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                writer.write_table(table.slice(start, stop - start))
+        manifest['row_groups'] = {str(df['county'].iat[start]): [int(start), int(stop)]
+                                  for start, stop in zip(bounds[:-1], bounds[1:])}
+
+        if 'tax_rate' in df:
+            county_stats(df).to_parquet(get_stats_filename(workbook))
+    else:
+        df.to_parquet(filename, index=False)
+
+    manifest['schema'] = {col: str(dtype) for col, dtype in df.dtypes.items()}
+    write_manifest(filename, manifest)
+    return df
+
+def read_workbook(workbook, columns=None, counties=None):
+    '''
+    This function returns the contents of a workbook from its parquet cache,
+    converting it first if the cache is stale. Passing a list of columns only
+    loads those columns, and passing counties (names) only reads their row groups.
+    '''
+    if not workbook_is_fresh(workbook):
+        convert_workbook(workbook)
+    filters = None if counties is None else [('county', 'in', list(counties))]
+    return pd.read_parquet(get_cache_filename(workbook), columns=columns, filters=filters)
+
+
+if __name__ == '__main__':
+    for workbook in WORKBOOK_SCHEMAS:
+        if os.path.isfile(workbook):
+            df = convert_workbook(workbook)
+            print(f'{workbook}: {len(df)} rows -> {get_cache_filename(workbook)}')